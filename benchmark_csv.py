@@ -0,0 +1,92 @@
+'''
+This script compares the CSV engines in csv_io.py on a synthetic Halo export. It writes a file shaped like
+    a real object data export (ids, regions, bounding boxes, phenotype flags, per-fluor intensities and
+    completeness columns, validation calls, notes), then times a projected read and a streamed
+    write-back with each engine that is installed.
+
+Example usage:
+    python benchmark_csv.py --rows 1000000
+'''
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import csv_io
+import object_data
+
+FLUORS = ['DAPI','Opal 480','Opal 520', 'Opal 570', 'Opal 620','Opal 690', 'Opal 720', 'Sample AF']
+STATUSES = ['Unseen', 'Needs review', 'Confirmed', 'Rejected']
+
+def make_synthetic(path, rows, seed = 0):
+    ''' Write a synthetic object data .csv with the given number of rows'''
+    rng = np.random.default_rng(seed)
+    data = {'Image Location': [r'\\server\share\slides\synthetic_slide.qptiff'] * rows,
+            'Analysis Region': rng.choice(['Layer 1', 'Layer 2', 'Tumor', 'Stroma'], size=rows),
+            'Algorithm Name': ['Indica Labs - HighPlex FL v4.1.3'] * rows,
+            'Object Id': np.arange(rows)}
+    xmin = rng.integers(0, 40000, size=rows); ymin = rng.integers(0, 30000, size=rows)
+    data.update({'XMin': xmin, 'XMax': xmin + rng.integers(5, 30, size=rows),
+                 'YMin': ymin, 'YMax': ymin + rng.integers(5, 30, size=rows)})
+    for fluor in FLUORS:
+        data[f'{fluor} Positive Classification'] = rng.integers(0, 2, size=rows)
+        for compartment in ['Cell', 'Nucleus', 'Cytoplasm']:
+            data[f'{fluor} {compartment} Intensity'] = np.round(rng.gamma(2.0, 5.0, size=rows), 4)
+            data[f'{fluor} % {compartment} Completeness'] = np.round(rng.uniform(0, 100, size=rows), 2)
+    for pheno in ['CTC 488pos', 'CTC 488neg', 'Other']:
+        data[pheno] = rng.integers(0, 2, size=rows)
+    data['Cell Area (µm²)'] = np.round(rng.uniform(20, 400, size=rows), 4)
+    data['Nucleus Area (µm²)'] = np.round(rng.uniform(5, 100, size=rows), 4)
+    calls = rng.integers(0, len(STATUSES), size=rows)
+    for i, status in enumerate(STATUSES):
+        data[f'Validation | {status}'] = (calls == i).astype(int)
+    data['Notes'] = np.where(rng.uniform(size=rows) < 0.01, 'looks like debris, check DAPI', '-')
+    pd.DataFrame(data).to_csv(path, index=False)
+
+def _timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:<28} {elapsed:8.2f}s')
+    return result, elapsed
+
+def run(path):
+    headers = csv_io.read_header(path)
+    columns = object_data.session_columns(headers)
+    schema = object_data.ObjectDataSchema(headers)
+    owned = [c for c in headers if c.startswith('Validation | ')] + ['Notes']
+    print(f'{os.path.getsize(path)/2**20:.0f} MB, {len(headers)} columns ({len(columns)} read by the viewer)\n')
+    results = {}
+    for engine in csv_io.available_engines():
+        csv_io.set_engine(engine)
+        print(engine)
+        _, full = _timed('full read', lambda: pd.concat(csv_io.read_chunks(path)))
+        df, projected = _timed('projected + downcast read', lambda: object_data._read_csv_projected(path, columns, schema))
+        copy_path = path + f'.{engine}.csv'
+        with open(path, 'rb') as src, open(copy_path, 'wb') as dst: dst.write(src.read())
+        _, write = _timed('streamed write-back', lambda: object_data.write_back(copy_path, df, owned))
+        os.remove(copy_path)
+        print(f'  {"table in memory":<28} {df.memory_usage(deep=True).sum()/2**20:8.0f} MB\n')
+        results[engine] = (full, projected, write)
+    csv_io.set_engine('auto')
+    if len(results) > 1:
+        speedups = [p/a for p, a in zip(results['pandas'], results['arrow'])]
+        print('Arrow speedup - full read {:.1f}x, projected read {:.1f}x, write-back {:.1f}x'.format(*speedups))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the object data CSV engines on a synthetic Halo export')
+    parser.add_argument('--rows', type=int, default=1000000, help='Number of cells in the synthetic file')
+    parser.add_argument('--file', default=None, help='Use this .csv instead of generating one')
+    parser.add_argument('--keep', action='store_true', help="Don't delete the generated file")
+    args = parser.parse_args()
+
+    path = args.file
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), f'synthetic_halo_{args.rows}.csv')
+        _timed(f'Generating {args.rows} rows', lambda: make_synthetic(path, args.rows))
+    try:
+        run(path)
+    finally:
+        if args.file is None and not args.keep: os.remove(path)
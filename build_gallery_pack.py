@@ -0,0 +1,102 @@
+'''
+This script builds a 'gallery pack' for an image and its Halo object data: every selected cell's
+    multichannel punchout is read once (on a pool of worker threads) and written to a single
+    memory-mapped file next to the object data, with a small sidecar index. When the viewer finds a
+    pack that matches the image and cell image size, pages are served by slicing the pack instead of
+    decoding the image. This only has to be run once per image / cell image size.
+
+Example usage:
+    python build_gallery_pack.py "C:/path/to/slide.qptiff" "C:/path/to/halo_export.csv" --size 100 --phenotype "CTC 488pos"
+'''
+
+import argparse
+import copy
+import os
+import time
+import numpy as np
+import pandas as pd
+import rasterio
+import tifffile
+import punchout_io
+
+def _open_image(image_path):
+    ''' Return (raster pool, pyramid, number of channels) using the same backends as the viewer'''
+    try:
+        with rasterio.open(image_path) as src:
+            raw_subdata = copy.copy(src.subdatasets)
+        subdatasets = punchout_io.filter_subdatasets(raw_subdata)
+        if not subdatasets: raise ValueError('No channel subdatasets found')
+        return punchout_io.RasterPool(subdatasets), None, len(subdatasets)
+    except Exception:
+        print('Could not read the image with rasterio, trying it as a memory-mapped tif')
+        pyramid = tifffile.memmap(image_path)
+        return None, pyramid, pyramid.shape[2] # Data is [X,Y,C]
+
+def select_cells(object_data_path, phenotypes, annotations):
+    ''' Read the columns needed to place cells and return (the rows kept by the filter, placement hash of the
+        whole table). Same rule as the viewer: a cell is kept if it is positive for any phenotype or in
+        any annotation layer given.'''
+    headers = pd.read_csv(object_data_path, index_col=False, nrows=0).columns.tolist()
+    usecols = [c for c in punchout_io.PLACEMENT_COLUMNS + phenotypes if c in headers]
+    df = pd.read_csv(object_data_path, index_col=False, usecols=usecols, dtype={"Analysis Region": str})
+    placement = punchout_io.placement_hash(df)
+    if phenotypes or annotations:
+        keep = np.zeros(len(df), dtype=bool)
+        for pheno in phenotypes:
+            keep |= (df[pheno] == 1).to_numpy()
+        if annotations and "Analysis Region" in df.columns:
+            keep |= df["Analysis Region"].isin(annotations).to_numpy()
+        df = df[keep]
+    return df, placement
+
+def build(image_path, object_data_path, punchout_size, phenotypes = [], annotations = [], workers = None, batch_size = 512):
+    data_path, index_path = punchout_io.gallery_pack_paths(object_data_path, punchout_size)
+    offset = int(punchout_size/2)
+    size = offset*2
+
+    with tifffile.Timer(f'\nReading object data from {object_data_path}...\n'):
+        cells, placement = select_cells(object_data_path, phenotypes, annotations)
+        print(f'{len(cells)} cells selected ... completed in ', end='')
+
+    pool, pyramid, num_channels = _open_image(image_path)
+    positions = list(range(num_channels))
+    centers_x = ((cells['XMax'] + cells['XMin'])/2).astype(int).to_numpy()
+    centers_y = ((cells['YMax'] + cells['YMin'])/2).astype(int).to_numpy()
+
+    pack = np.lib.format.open_memmap(data_path, mode='w+', dtype=np.uint8, shape=(len(cells), num_channels, size, size))
+    start = time.time()
+    try:
+        for first in range(0, len(cells), batch_size):
+            last = min(first+batch_size, len(cells))
+            centers = list(zip(centers_x[first:last].tolist(), centers_y[first:last].tolist()))
+            pack[first:last] = punchout_io.extract_page_punchouts(centers, positions, offset, pool=pool, pyramid=pyramid, workers=workers)
+            print(f'\r {last}/{len(cells)} cells | {time.time()-start:.0f}s elapsed', end='')
+        pack.flush()
+    finally:
+        if pool is not None: pool.close()
+    del pack
+
+    # Sidecar index: which table row and cell each slot of the pack holds
+    if "Analysis Region" in cells.columns:
+        regions = cells["Analysis Region"].astype(str)
+    else:
+        regions = pd.Series(['All'] * len(cells))
+    region_names = sorted(regions.unique().tolist())
+    region_codes = pd.Categorical(regions, categories=region_names).codes
+    meta = {'image_name': os.path.basename(image_path), 'image_bytes': os.path.getsize(image_path),
+            'punchout_size': punchout_size, 'pyramid_level': 0, 'channels': num_channels,
+            'phenotypes': phenotypes, 'annotations': annotations, 'placement_hash': placement}
+    punchout_io.write_gallery_pack_index(index_path, meta, region_names, region_codes,
+                                         cells["Object Id"].to_numpy(), cells.index.to_numpy())
+    print(f'\nWrote {data_path} and {index_path} in {time.time()-start:.0f}s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute every selected cell image for the gallery viewer')
+    parser.add_argument('image', help='Path to the .qptiff, or a memory-mapped tif made with convert_tif.py')
+    parser.add_argument('object_data', help='Path to the Halo object data .csv')
+    parser.add_argument('--size', type=int, default=100, help='Cell image size in pixels. Must match the viewer setting')
+    parser.add_argument('--phenotype', action='append', default=[], help='Keep cells positive for this phenotype. Can be repeated')
+    parser.add_argument('--annotation', action='append', default=[], help='Keep cells in this annotation layer. Can be repeated')
+    parser.add_argument('--workers', type=int, default=None, help='Number of reader threads. Defaults to the CPU count, up to 8')
+    args = parser.parse_args()
+    build(args.image, args.object_data, args.size, phenotypes=args.phenotype, annotations=args.annotation, workers=args.workers)
@@ -0,0 +1,80 @@
+'''
+Project - CTC Gallery viewer with Napari
+
+Description - cell ID labels for the status layer
+    The font is loaded once. Each label is rasterized once per (text, size) as a grayscale coverage
+    mask, drawn large and shrunk with Lanczos so it stays legible at small sizes. Colouring a label
+    for a status is then a linear blend of the mask between the background and the status colour,
+    so changing a status or revisiting a page costs a few array operations instead of a redraw.
+
+Peter Richieri
+Ting Lab
+2023
+'''
+
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, ImageFont, ImageDraw
+
+FONT_FILE = 'arial.ttf'
+FONT_SIZE = 48
+UPSAMPLE = 3.5 # Text is drawn this many times larger than it is shown, then downsampled
+TEXT_ORIGIN = (60, 1) # Where the text starts, in upsampled pixels
+MAX_LABELS = 2048 # Masks kept in memory. A gallery mode label is about 16 x 816 bytes
+
+_FONT = None
+_MASKS = OrderedDict() # (text, height, width) -> uint8 coverage mask, least recently used first
+_LABELS = OrderedDict() # (text, height, width, colour, absorption) -> coloured RGBA label, least recently used first
+
+def _font():
+    global _FONT
+    if _FONT is None:
+        try:
+            _FONT = ImageFont.truetype(FONT_FILE, FONT_SIZE)
+        except OSError:
+            print(f"Couldn't load {FONT_FILE}, cell labels will use PIL's default font")
+            _FONT = ImageFont.load_default()
+    return _FONT
+
+def display_text(cell_name):
+    ''' '<region> <id>' -> '<id> <region>', the order the label shows'''
+    anno, _, i = cell_name.rpartition(' ') # only the trailing id, region names can hold numbers too
+    return i + " " + anno
+
+def _cached(cache, key):
+    value = cache.get(key)
+    if value is not None: cache.move_to_end(key)
+    return value
+
+def _remember(cache, key, value):
+    cache[key] = value
+    while len(cache) > MAX_LABELS:
+        cache.popitem(last=False)
+    return value
+
+def text_mask(text, height, width):
+    ''' Return the coverage (0-255) of the text drawn in a height x width strip. Cached, don't modify it.'''
+    key = (text, height, width)
+    mask = _cached(_MASKS, key)
+    if mask is not None: return mask
+    canvas = Image.new('L', (int(UPSAMPLE*width), int(UPSAMPLE*height)), 0)
+    ImageDraw.Draw(canvas).text(TEXT_ORIGIN, text, 255, font = _font())
+    return _remember(_MASKS, key, np.asarray(canvas.resize((width, height), Image.Resampling.LANCZOS)))
+
+def render_label(cell_name, height, width, color, absorption):
+    ''' Return an RGBA uint8 array of shape (height, width, 4) with the cell's label in the given colour.
+        The background is black (white in absorption mode) and transparent, the text is opaque.
+        Cached, so copy it (e.g. by assigning it into a larger array) before changing it.'''
+    key = (display_text(cell_name), height, width, tuple(color), absorption)
+    label = _cached(_LABELS, key)
+    if label is not None: return label
+    bg = 255 if absorption else 0
+    coverage = text_mask(display_text(cell_name), height, width).astype(np.float32) / 255
+    label = np.empty((height, width, 4), dtype=np.uint8)
+    label[:,:,:3] = np.rint(bg + (np.asarray(color[:3], dtype=np.float32) - bg) * coverage[:,:,None])
+    if absorption:
+        label[:,:,3] = 255 * (label[:,:,:3] < 200).any(axis=2)
+    else:
+        label[:,:,3] = 255 * (label[:,:,:3] > 50).any(axis=2)
+    label.flags.writeable = False
+    return _remember(_LABELS, key, label)
@@ -1,35 +1,67 @@
 '''
-This script contains code that will convert a large tif to a memory mapped format 
+This script contains code that will convert a large tif to a memory mapped format
     for faster loading with the gallery viewer application. This will only have to be run once.
-'''
 
-import tifffile
-import numpy as np
-# import re
-import time
+The source is streamed one tile (or strip) at a time into the output file, so memory use stays
+    bounded no matter how big the slide is. The output is laid out as [X, Y, C] so that the viewer's
+    pyramid[x0:x1, y0:y1, channel] slices read a small, mostly contiguous block for each cell.
 
-input_image = r"C:\Users\prich\Desktop\Projects\MGH\CTC_Example\Exp02a01_02_Scan1.qptiff"
+Example usage:
+    python convert_tif.py "C:/path/to/slide.qptiff" -o "C:/path/to/slide_memmap.tif"
+'''
 
-with tifffile.Timer(f'\nLoading pyramid from {input_image} into RAM...\n'):
-    pyramid = tifffile.imread(input_image)
-    pyramid = np.transpose(pyramid,(2,1,0))
-    # pyramid = pyramid[:2000,:2000,1]
-    print('... completed in ', end='')
+import argparse
+import os
+import time
+import tifffile
 
+def default_output_path(input_image):
+    root, _ = os.path.splitext(input_image)
+    return root + "_memory_mapped.tif"
 
-print(f"\n shape is {pyramid.shape}\n")
+def convert(input_image, output_image, flush_every = 256):
+    ''' Copy the full resolution level of input_image into a new memory-mapped tif with shape (X, Y, C).
+        flush_every - number of tiles / strips to copy before flushing written pages to disk'''
+    with tifffile.TiffFile(input_image) as tif:
+        series = tif.series[0]
+        pages = [p for p in series.pages if p is not None] # full resolution level only, one page per channel
+        height, width = pages[0].shape[:2]
+        dtype = pages[0].dtype
+        shape = (width, height, len(pages))
+        print(f"\n Source is {len(pages)} channels of {height} x {width} ({dtype}). Output shape will be {shape}\n")
 
-print(f'\nCreating memory-mapped tif...\n')
-cur = time.time()
-new_name = "memory_mapped_array.tif" #TODO make a default that is a modification 
-mm_image = tifffile.memmap(new_name, shape = pyramid.shape, dtype=pyramid.dtype,photometric='minisblack')
-print("Created empty .tif")
-mm_image[:] = pyramid[:]
-print("Passed data")
-print(f'... completed in {time.time()-cur}', end='')
+        mm_image = tifffile.memmap(output_image, shape = shape, dtype = dtype, photometric='minisblack')
+        print("Created empty .tif")
+        total = sum(len(p.dataoffsets) for p in pages)
+        done = 0
+        start = time.time()
+        for channel, page in enumerate(pages):
+            # segments() decodes one tile or strip at a time. Edge tiles are padded, so crop them to the image
+            for segment, indices, segment_shape in page.segments():
+                done += 1
+                if segment is None: continue # empty tile, the output is already zero
+                y0, x0 = indices[-3], indices[-2]
+                segment = segment.reshape(segment_shape)[0,:,:,0] # (depth, length, width, samples) -> 2D
+                h = min(segment.shape[0], height - y0)
+                w = min(segment.shape[1], width - x0)
+                mm_image[x0:x0+w, y0:y0+h, channel] = segment[:h,:w].T
+                if done % flush_every == 0:
+                    mm_image.flush()
+                    elapsed = time.time()-start
+                    print(f'\r Channel {channel+1}/{len(pages)} | {100*done/total:.1f}% | {elapsed:.0f}s elapsed', end='')
+        print(f'\r Copied {done} tiles in {time.time()-start:.0f}s'+' '*20)
 
+    cur = time.time()
+    print("\nWriting to disk...")
+    mm_image.flush() # Write to disk
+    del mm_image
+    print(f'... completed in {time.time()-cur}', end='')
 
-cur = time.time()
-print("\nWriting to disk...")
-mm_image.flush() # Write to disk
-print(f'... completed in {time.time()-cur}', end='')
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a QPTIFF / tif into a memory-mapped tif for the gallery viewer')
+    parser.add_argument('input', help='Path to the .qptiff or .tif to convert')
+    parser.add_argument('-o', '--output', default=None, help='Path of the memory-mapped tif to create. Defaults to <input>_memory_mapped.tif')
+    parser.add_argument('--flush-every', type=int, default=256, help='Number of tiles to copy between flushes to disk')
+    args = parser.parse_args()
+    output = args.output if args.output else default_output_path(args.input)
+    convert(args.input, output, flush_every = args.flush_every)
@@ -0,0 +1,127 @@
+'''
+Project - CTC Gallery viewer with Napari
+
+Description - reading and writing the object data .csv
+    Every read and write of a Halo export goes through here, so the parser can be swapped. When pyarrow
+    is installed its multi-threaded CSV reader and writer are used, otherwise (or if Arrow can't handle
+    a file) the pandas C parser is used, same as before. See benchmark_csv.py to compare the two.
+
+Peter Richieri
+Ting Lab
+2023
+'''
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
+ENGINE = 'auto' # 'auto', 'arrow' or 'pandas'. 'auto' uses Arrow when it is installed
+CHUNK_ROWS = 200000 # Rows per chunk for the pandas parser
+ARROW_BLOCK_BYTES = 64 * 2**20 # Bytes per chunk for the Arrow parser. Each block is parsed on several threads
+TEXT_COLUMNS = ['Analysis Region', 'Image Location', 'Image File Name', 'Algorithm Name', 'Notes'] # Always read as strings
+
+def available_engines():
+    return ['arrow', 'pandas'] if pacsv is not None else ['pandas']
+
+def set_engine(name):
+    ''' Choose the parser. Asking for Arrow when it isn't installed falls back to pandas.'''
+    global ENGINE
+    if name not in ('auto', 'arrow', 'pandas'):
+        raise ValueError(f"Unknown CSV engine '{name}'. Use 'auto', 'arrow' or 'pandas'")
+    ENGINE = name
+
+def current_engine():
+    if ENGINE in ('auto', 'arrow') and pacsv is not None:
+        return 'arrow'
+    return 'pandas'
+
+def read_header(path):
+    return pd.read_csv(path, index_col=False, nrows=0).columns.tolist()
+
+def _arrow_reader(path, columns, as_text):
+    headers = read_header(path)
+    if as_text:
+        column_types = {c: pa.string() for c in headers}
+    else:
+        column_types = {c: pa.string() for c in TEXT_COLUMNS if c in headers}
+    read_options = pacsv.ReadOptions(use_threads=True, block_size=ARROW_BLOCK_BYTES)
+    convert_options = pacsv.ConvertOptions(include_columns=columns, column_types=column_types,
+                                           strings_can_be_null=not as_text, quoted_strings_can_be_null=not as_text)
+    return pacsv.open_csv(path, read_options=read_options, convert_options=convert_options)
+
+def iter_chunks(path, columns = None, as_text = False, engine = None):
+    ''' Yield the file as DataFrames of consecutive rows. columns limits what is read. With as_text every
+        value comes back as the exact string in the file, empty cells as ''.'''
+    if engine is None: engine = current_engine()
+    if engine == 'arrow':
+        for batch in _arrow_reader(path, columns, as_text):
+            yield batch.to_pandas()
+    else:
+        if as_text:
+            reader = pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=False, na_filter=False, chunksize=CHUNK_ROWS)
+        else:
+            dtype = {c: str for c in TEXT_COLUMNS}
+            reader = pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=CHUNK_ROWS)
+        for chunk in reader:
+            yield chunk
+
+def read_chunks(path, columns = None, convert = None):
+    ''' Read the file chunk by chunk, passing each chunk through convert() (e.g. to downcast it) before the
+        next one is read. Returns the list of converted chunks. If Arrow fails part way through (its
+        types are guessed from the first block) the whole read is redone with pandas.'''
+    if convert is None: convert = lambda chunk: chunk
+    engine = current_engine()
+    if engine == 'arrow':
+        try:
+            return [convert(chunk) for chunk in iter_chunks(path, columns, engine='arrow')]
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            print(f'Arrow could not parse {path}, reading it with pandas instead: {e}')
+    return [convert(chunk) for chunk in iter_chunks(path, columns, engine='pandas')]
+
+class CsvWriter:
+    ''' Writes DataFrames to a .csv one after another. The first one sets the header. Use as a context manager.
+        Arrow quotes every string-typed value, even with quoting_style='needed', so only the pandas engine
+        reproduces a file that was read as text. Use engine='pandas' to write a file back.'''
+    def __init__(self, path, engine = None) -> None:
+        self.path = path
+        self.engine = engine if engine is not None else current_engine()
+        self._file = None
+        self._writer = None # Arrow writer, opened with the first table
+        self._schema = None
+
+    def __enter__(self):
+        if self.engine == 'arrow':
+            self._file = open(self.path, 'wb')
+        else:
+            self._file = open(self.path, 'w', newline='', encoding='utf-8')
+        return self
+
+    def write(self, df):
+        if self.engine == 'pandas':
+            df.to_csv(self._file, index=False, header=(self._schema is None))
+            self._schema = list(df.columns)
+            return None
+        table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema
+            try:
+                options = pacsv.WriteOptions(include_header=True, quoting_style='needed') # numbers unquoted, strings still quoted
+            except TypeError: # older pyarrow has no quoting_style
+                options = pacsv.WriteOptions(include_header=True)
+            self._writer = pacsv.CSVWriter(self._file, self._schema, write_options=options)
+        self._writer.write_table(table)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._writer is not None: self._writer.close()
+        self._file.close()
+        return False
+
+def write_csv(df, path, engine = None):
+    ''' Write a whole DataFrame'''
+    with CsvWriter(path, engine) as writer:
+        writer.write(df)
@@ -0,0 +1,133 @@
+'''
+Project - CTC Gallery viewer with Napari
+
+Description - append-only journal of scoring decisions
+    Every status change and note is appended to a small file next to the object data as soon as it is
+    made, so a crash loses nothing. Writes are flushed to disk in batches (every few records or
+    fraction of a second, whichever comes first). When the object data .csv is saved, the journal is
+    rotated aside first, and the rotated part is deleted once the .csv write succeeds. On startup,
+    anything left over is replayed over the table.
+
+Peter Richieri
+Ting Lab
+2023
+'''
+
+import os
+import json
+import time
+import threading
+
+FSYNC_EVERY = 32 # Records written between fsyncs
+FSYNC_INTERVAL = 0.5 # Seconds - max time a record can sit in the OS buffer before an fsync
+COMPACT_AFTER = 200 # Records journaled before a background save folds them into the .csv
+
+def journal_paths(object_data_path):
+    ''' Return (journal path, rotated journal path, lock path) for an object data file'''
+    root, _ = os.path.splitext(object_data_path)
+    return root + '.decisions.journal', root + '.decisions.journal.compacting', root + '.decisions.journal.lock'
+
+class DecisionJournal:
+    ''' Append-only log of (cell name, status) and (cell name, note) records, one JSON object per line.'''
+    def __init__(self, object_data_path) -> None:
+        self.path, self.rotated_path, self.lock_path = journal_paths(object_data_path)
+        self.pending = 0 # Records written since the last fsync
+        self.records_since_rotate = 0
+        self._last_sync = time.monotonic()
+        self._file = None
+        self._locked = False
+        self._lock = threading.Lock()
+
+    def acquire_session_lock(self):
+        ''' Mark the journal as in use. Returns False if another session (or one that crashed) held it.
+            The lock is taken over either way, it is only used to warn the user.'''
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            acquired = True
+        except FileExistsError:
+            fd = os.open(self.lock_path, os.O_TRUNC | os.O_WRONLY)
+            acquired = False
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        self._locked = True
+        return acquired
+
+    def open(self):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+
+    def record_status(self, cell_name, status):
+        self._append({'cell': cell_name, 'status': status})
+
+    def record_note(self, cell_name, note):
+        self._append({'cell': cell_name, 'note': str(note)})
+
+    def _append(self, record):
+        with self._lock:
+            if self._file is None: return None # closed, the caller is about to save to disk anyway
+            self._file.write(json.dumps(record) + '\n')
+            self.pending += 1
+            self.records_since_rotate += 1
+            if self.pending >= FSYNC_EVERY or time.monotonic() - self._last_sync > FSYNC_INTERVAL:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.pending = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None and self.pending: self._sync()
+
+    def rotate(self):
+        ''' Move everything journaled so far into the rotated file (appending, if a previous save of it
+            failed) and start an empty journal. Returns the rotated path. Call this just before the
+            decisions in memory are written to the .csv, and discard_rotated() once that succeeds.'''
+        with self._lock:
+            reopen = self._file is not None
+            if reopen:
+                self._sync()
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                if os.path.exists(self.rotated_path):
+                    with open(self.path, 'r', encoding='utf-8') as src, open(self.rotated_path, 'a', encoding='utf-8') as dst:
+                        dst.write(src.read())
+                        dst.flush(); os.fsync(dst.fileno())
+                    os.remove(self.path)
+                else:
+                    os.replace(self.path, self.rotated_path)
+            self.records_since_rotate = 0
+            if reopen: self._file = open(self.path, 'a', encoding='utf-8')
+        return self.rotated_path
+
+    def discard_rotated(self):
+        ''' The rotated records are safely in the .csv now'''
+        if os.path.exists(self.rotated_path): os.remove(self.rotated_path)
+
+    def replay(self):
+        ''' Return the records left over from an earlier session, oldest first. A torn last line
+            (from a crash mid-write) is skipped.'''
+        records = []
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path): continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        print(f'Skipping an unreadable line in {path}')
+        return records
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+        if self._locked and os.path.exists(self.lock_path):
+            os.remove(self.lock_path)
+            self._locked = False
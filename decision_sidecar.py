@@ -0,0 +1,62 @@
+'''
+Project - CTC Gallery viewer with Napari
+
+Description - scoring decisions kept in a small SQLite file next to the object data
+    In sidecar mode a save writes only the cells whose status or note changed, one row per cell keyed
+    by (analysis region, object id), instead of rewriting the whole Halo export. The decisions are
+    applied over the table when the data is loaded, and merged into the .csv only when the user
+    exports (a streamed write-back, see object_data.write_back).
+
+Peter Richieri
+Ting Lab
+2023
+'''
+
+import os
+import sqlite3
+
+def sidecar_path(object_data_path):
+    root, _ = os.path.splitext(object_data_path)
+    return root + '.decisions.sqlite'
+
+def split_cell_name(cell_name):
+    ''' '<region> <id>' (or 'All <id>') -> (region, int id). Returns None for a name without a numeric id'''
+    cid = cell_name.split()[-1]
+    if not cid.isdigit(): return None
+    return cell_name[:-len(cid)].rstrip(), int(cid)
+
+class DecisionSidecar:
+    ''' Table of (region, object id, status, note), one row per cell that has been scored.
+        A connection is opened per call, so the saver thread and the GUI thread never share one.'''
+    def __init__(self, object_data_path) -> None:
+        self.path = sidecar_path(object_data_path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS decisions (region TEXT NOT NULL, object_id INTEGER NOT NULL,
+                        status TEXT NOT NULL, note TEXT NOT NULL, PRIMARY KEY (region, object_id))''')
+        return conn
+
+    def write(self, rows):
+        ''' Insert or replace (region, object id, status, note) rows in one transaction. Returns the row count.'''
+        if not rows: return 0
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?)', rows)
+        finally:
+            conn.close()
+        return len(rows)
+
+    def read_all(self):
+        ''' Return every stored (region, object id, status, note) row'''
+        if not self.exists(): return []
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT region, object_id, status, note FROM decisions').fetchall()
+        finally:
+            conn.close()
@@ -7,12 +7,11 @@ Peter Richieri
 # import IPython
 import tifffile
 import rasterio
-from rasterio.windows import Window
 import napari
 from napari.types import ImageData
 from magicgui import magicgui #, magic_factory
 from PyQt5.QtWidgets import QLabel, QLineEdit, QPushButton, QRadioButton, QCheckBox, QButtonGroup, QSizePolicy, QComboBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, pyqtSignal
 import numpy as np
 import pandas as pd
 import openpyxl # necessary, do not remove
@@ -21,9 +20,12 @@ from matplotlib import colors as mplcolors # Necessary, do not remove
 import copy
 import time
 import store_and_load
+import punchout_io
+import object_data
+import status_boxes
+import status_overlay
 import custom_maps # Necessary, do not remove
 from math import ceil
-from PIL import Image, ImageFont, ImageDraw
 from re import sub
 import os
 # from initial_UI import VERSION_NUMBER
@@ -69,7 +71,7 @@ CHANNELS_STR.append("Composite") # Seems like this has to happen on a separate l
 ADJUSTED = copy.copy(CHANNELS_STR)
 VIEWER = None
 ADJUSTMENT_SETTINGS={"DAPI gamma": 0.5}; ORIGINAL_ADJUSTMENT_SETTINGS = {}
-SAVED_INTENSITIES={}; XY_STORE = [1,2,3]
+XY_STORE = [1,2,3]
 RAW_PYRAMID=None
 ALL_CUSTOM_WIDGETS = {}
 COMPOSITE_MODE = True # Start in composite mode
@@ -83,6 +85,22 @@ IMAGE_LAYERS = {}
 UPDATED_CHECKBOXES = []
 ANNOTATIONS_PRESENT = False # Track whether there is an 'Analysis Regions' field in the data (duplicate CIDs possible)
 ABSORPTION = False
+PUNCHOUT_WORKERS = punchout_io.DEFAULT_WORKERS # Number of threads used to read the punchouts for a page
+PUNCHOUT_CACHE = None # punchout_io.PunchoutCache shared by page loads, mode switches and the prefetcher
+PREFETCHER = None # punchout_io.PagePrefetcher that reads the pages before and after the current one
+GALLERY_PACK = None # punchout_io.GalleryPack of precomputed punchouts, if one was built for this data (see build_gallery_pack.py)
+REVIEW_ORDER = None # Int array - row positions in userInfo.objectDataFrame of the cells under review, filtered and globally sorted
+REVIEW_ORDER_KEY = None # The (phenotypes, annotations, global sort, row count) that REVIEW_ORDER was computed for
+REVIEW_LOOKUP = None # pd.Index of (region code, Object Id) keys in review order. Finds a cell's position in REVIEW_ORDER
+REVIEW_REGION_CODES = {} # Analysis Region name -> the code used for it in REVIEW_LOOKUP
+CURRENT_PAGE = 1
+INTENSITY_MAP = None # object_data.IntensityMap - the cyto / nucleus / cell intensity columns for each channel
+PAGE_INTENSITIES = None # Float32 array (cells on the page, channels, 3) of cyto, nucleus and cell intensities
+PAGE_CELL_ROWS = {} # Cell name -> row of PAGE_INTENSITIES
+SAVER = None # BackgroundSaver that writes decisions to the object data file without blocking the viewer
+VECTOR_STATUS = False # Draw the status overlay as napari shapes and text instead of an RGBA image
+STATUS_OVERLAY = None # status_overlay.VectorStatusOverlay for the current page, when VECTOR_STATUS is on
+VIEWER_KEY_ACTIONS = {} # Every viewer key binding, by key, so the vector status layer can pass them on
 
 
 ######------------------------- MagicGUI Widgets, Functions, and accessories ---------------------######
@@ -336,6 +354,10 @@ def show_next_cell_group(page_cb_widget, single_cell_lineEdit,single_cell_combo,
         sort_option = intensity_sort_widget.currentText().split()[3]
 
 
+    # Free up the reader threads for the page that was asked for. A neighbouring page that is being
+    # read stops at its next channel read instead of queueing ahead of this one
+    if PREFETCHER is not None: PREFETCHER.cancel()
+
     # Save data to file from current set
     #TODO Fix amount field
     if not _save_validation(VIEWER, PAGE_SIZE):
@@ -355,6 +377,8 @@ def show_next_cell_group(page_cb_widget, single_cell_lineEdit,single_cell_combo,
     else:
         VIEWER.layers.clear()
         add_layers(VIEWER,RAW_PYRAMID, xydata, int(PUNCHOUT_SIZE/2), composite_only=COMPOSITE_MODE)
+        prefetch_neighbouring_pages() # sort, filter or page may have changed, so point the prefetcher at the new neighbours
+        if userInfo.journal_needs_compaction(): SAVER.request() # fold a long journal into the .csv in the background
     
     single_cell_lineEdit.clear() # reset the widgets
     if single_cell_combo: single_cell_combo.setCurrentIndex(0) # reset the widgets
@@ -388,6 +412,9 @@ def toggle_statuslayer_visibility(show_widget):
     return None
 
 def toggle_statusbox_visibility(show_widget):
+    if STATUS_OVERLAY is not None:
+        STATUS_OVERLAY.set_boxes_visible(show_widget.isChecked())
+        return None
     if show_widget.isChecked(): Status_Box_Visibility = 1
     else: Status_Box_Visibility = 2
     # Find status layers and toggle visibility
@@ -448,58 +475,21 @@ def set_notes_label(display_note_widget, ID):
     status = SESSION.status_list[str(ID)]
     prefix = f'{SESSION.saved_notes["page"]}<br><font color="{STATUSES_TO_HEX[status]}">{image_name}</font>'
 
-    # Add intensities
-    intensity_series = SAVED_INTENSITIES[ID]
-    names = list(intensity_series.index)
+    # Add intensities. These are looked up in the page's intensity array, the columns were found at load
+    row = PAGE_CELL_ROWS.get(ID)
     intensity_str = ''
     for pos in CHANNELS:
         fluor = list(CHANNEL_ORDER.keys())[pos]
         if fluor == 'Composite':
             continue
-        # fluor = str(cell).replace(" Cell Intensity","")
-        fluor = str(fluor)
-        intensity_str += f'<br><font color="{CHANNEL_ORDER[fluor].replace("blue","#0462d4")}">{fluor.replace("OPAL","Opal ")}'
-        def add_values(intensity_str, fluor, intensity_lookup):
-            flag = True
-            name = intensity_lookup.replace("OPAL","Opal ") + ': No data'
-            try:
-                cyto = intensity_lookup.replace("OPAL","Opal ")
-                cyto = [x for x in names if (cyto in x and 'Cytoplasm Intensity' in x)][0]
-                val = round(float(intensity_series[cyto]),1)
-                intensity_str += f'<font color="{CHANNEL_ORDER[fluor].replace("blue","#0462d4")}"> cyto: {val}</font>'
-                flag = False
-                name = cyto.replace(' Cytoplasm Intensity','')
-            except (KeyError, IndexError): pass
-            try:
-                nuc = intensity_lookup.replace("OPAL","Opal ")
-                nuc = [x for x in names if (nuc in x and 'Nucleus Intensity' in x)][0]
-                val = round(float(intensity_series[nuc]),1)
-                intensity_str += f'<font color="{CHANNEL_ORDER[fluor].replace("blue","#0462d4")}"> nuc: {val}</font>'
-                flag = False
-                name = nuc.replace(' Nucleus Intensity','')
-            except (KeyError, IndexError): pass
-            try:
-                cell = intensity_lookup.replace("OPAL","Opal ")
-                cell = [x for x in names if (cell in x and 'Cell Intensity' in x)][0]
-                val = round(float(intensity_series[cell]),1)
-                intensity_str += f'<font color="{CHANNEL_ORDER[fluor].replace("blue","#0462d4")}"> cell: {val}</font>'
-                flag = False
-                name = cell.replace(' Cell Intensity','')
-            except (KeyError, IndexError): pass
-            return intensity_str.replace(intensity_lookup.replace("OPAL","Opal "),name), flag
-        intensity_str, error = add_values(intensity_str, fluor,fluor)
-        possible_af_strings = ['AF', 'Autofluorescence', 'Sample AF']
-        if error and fluor in possible_af_strings:
-            possible_af_strings.remove(fluor)
-            while possible_af_strings:
-                new = possible_af_strings.pop()
-                intensity_str, error = add_values(intensity_str,"AF", new)
-                if not error: 
-                    break
-        # Should have something from the fluorescence column if it's there
-
-
-        # intensity_str += f'<br><font color="{CHANNEL_ORDER[fluor.replace(" ","").upper()].replace("blue","#0462d4")}">{fluor} cyto: {round(float(intensity_series[cyto]),1)} nuc: {round(float(intensity_series[nuc]),1)} cell: {round(float(intensity_series[cell]),1)}</font>'
+        color = CHANNEL_ORDER[fluor].replace("blue","#0462d4")
+        values = PAGE_INTENSITIES[row, pos] if row is not None else []
+        found = [f' {label}: {round(float(val),1)}' for label, val in zip(['cyto', 'nuc', 'cell'], values) if not np.isnan(val)]
+        if found:
+            intensity_str += f'<br><font color="{color}">{INTENSITY_MAP.display_names[pos]}' + ''.join(found) + '</font>'
+        else:
+            intensity_str += f'<br><font color="{color}">{INTENSITY_MAP.display_names[pos]}: No data</font>'
+
     # Add note if it exists
     if note == '-' or note == '' or note is None: 
         note = prefix + intensity_str
@@ -509,7 +499,65 @@ def set_notes_label(display_note_widget, ID):
     return True
 ######------------------------- Image loading and processing functions ---------------------######
 
+def paint_status_box(buffer, row, col, status, cell_name, composite_only, fill = True):
+    ''' Draw a cell's status box in place on the status layer data. row and col are 1-based grid positions.
+        In gallery mode the box spans the whole row, so col is ignored.'''
+    box_width = (PUNCHOUT_SIZE+2) if composite_only else (PUNCHOUT_SIZE+2) * CELLS_PER_ROW
+    box_template = status_boxes.template(PUNCHOUT_SIZE, box_width, ABSORPTION, NO_LABEL_BOX)
+    left = (col-1)*(PUNCHOUT_SIZE+2) if composite_only else 0
+    return status_boxes.paint(buffer, (row-1)*(PUNCHOUT_SIZE+2), left, box_template, STATUSES_RGBA[status], cell_name, fill = fill)
+
+def refresh_status_region(status_layer, region = None):
+    ''' Show changes made in place to the status layer data. With a (top, left, height, width) region only
+        that part of the layer's texture is re-uploaded. This goes through vispy's private texture API, so
+        if that isn't available (or the texture doesn't match the data) the whole layer is refreshed.'''
+    if region is not None:
+        top, left, height, width = region
+        try:
+            qt_viewer = getattr(VIEWER.window, '_qt_viewer', None) or VIEWER.window.qt_viewer
+            node = qt_viewer.layer_to_visual[status_layer].node
+            texture = node._texture
+            if tuple(texture.shape[:2]) == status_layer.data.shape[:2]:
+                texture.scale_and_set_data(status_layer.data[top:top+height, left:left+width], offset=(top, left))
+                node.update()
+                return True
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+    status_layer.refresh()
+    return False
+
+def show_status(status_layer, row, col, status, cell_name):
+    ''' Redraw one cell's status on whichever kind of status overlay is in use'''
+    if STATUS_OVERLAY is not None:
+        return STATUS_OVERLAY.set_status(cell_name, status)
+    region = paint_status_box(status_layer.data, row, col, status, cell_name, COMPOSITE_MODE, fill=False)
+    return refresh_status_region(status_layer, region)
+
+def show_all_statuses(status_layer):
+    ''' Redraw the status of every cell on the page'''
+    if STATUS_OVERLAY is not None:
+        return STATUS_OVERLAY.set_statuses({name: SESSION.status_list[name] for name in STATUS_OVERLAY.index})
+    for coords, cell_name in GRID_TO_ID.items():
+        row, col = (int(x) for x in coords.split(','))
+        paint_status_box(status_layer.data, row, col, SESSION.status_list[cell_name], cell_name, COMPOSITE_MODE, fill=False)
+    return refresh_status_region(status_layer)
+
+def _vector_status_overlay(viewer, composite_only, scale):
+    ''' Build the shapes status overlay for the cells in GRID_TO_ID'''
+    names = []; boxes = []
+    width = (PUNCHOUT_SIZE+2) if composite_only else (PUNCHOUT_SIZE+2) * CELLS_PER_ROW
+    for coords, cell_name in GRID_TO_ID.items():
+        row, col = (int(x) for x in coords.split(','))
+        if not composite_only and col != 1: continue # in gallery mode one box spans the row
+        boxes.append(((row-1)*(PUNCHOUT_SIZE+2), (col-1)*(PUNCHOUT_SIZE+2), PUNCHOUT_SIZE+2, width))
+        names.append(cell_name)
+    return status_overlay.VectorStatusOverlay(viewer, boxes, names, [SESSION.status_list[n] for n in names],
+                                              STATUSES_RGBA, label_only=NO_LABEL_BOX, scale=scale)
+
 def change_statuslayer_color(cells):
+    if STATUS_OVERLAY is not None: # shapes don't need redrawing, just recolouring
+        STATUS_OVERLAY.set_statuses({name: SESSION.status_list[name] for name in STATUS_OVERLAY.index})
+        return None
     status_colors = STATUS_COLORS
     composite_only=COMPOSITE_MODE
     def retrieve_status(cell_id):
@@ -518,60 +566,9 @@ def change_statuslayer_color(cells):
         except:
             raise Exception(f"Looking for {cell_id} in the Status list dict but can't find it. List here:\n {SESSION.status_list}")
 
-    ''' Expects a numpy array of shape PUNCHOUT_SIZE x 16, with a 16x16 box taking up the left-hand side'''    
-    def write_cid_text_to_array(cb_size, im_length, upsample, color, cid):
-        if ABSORPTION: bg_color = (255,255,255,255)
-        else: bg_color = (0,0,0,255)
-        new = Image.new("RGBA", (int(upsample*im_length),int(upsample*cb_size)), bg_color)
-        font = ImageFont.truetype("arial.ttf",48)
-        editable_image = ImageDraw.Draw(new)
-
-        # switch CID order
-        i = cid.split()[-1]; anno = cid.replace(' '+i,'')
-        cid = i + " " + anno
-        editable_image.text((60,1), str(cid), color, font = font)
-        resized = np.array(new.resize((im_length,cb_size), Image.Resampling.LANCZOS))
-        np.save("lanczos", resized)
-        if ABSORPTION:
-            resized[:,:,0]
-            resized[:,:,3] = (255* (resized[:,:,:3] <200).any(axis=2)).astype(np.uint8)
-        else:
-            resized[:,:,3] = (255* (resized[:,:,:3] >50).any(axis=2)).astype(np.uint8)
-        return resized
-
-    def generate_status_box(status, cid, composite_only):
-        color_tuple = STATUSES_RGBA[status]
-        upsample = {True : 3.5, False: 3.5 }
-
-        corner_box_size = 16
-        edge_width = 1
-        if composite_only:
-            layer_length = (PUNCHOUT_SIZE+(edge_width*2))
-        else:
-            layer_length = (PUNCHOUT_SIZE+(edge_width*2)) * CELLS_PER_ROW
-
-        if NO_LABEL_BOX:
-            number_only = write_cid_text_to_array(PUNCHOUT_SIZE+(edge_width*2), layer_length, upsample[COMPOSITE_MODE], color_tuple, cid)
-            return number_only
-
-        top_or_bottom = [color_tuple, ] *layer_length
-        if ABSORPTION:
-            x = np.array([[color_tuple, (255,255,255,0), color_tuple]])
-        else:
-            x = np.array([[color_tuple, (0,0,0,0), color_tuple]])
-        y = np.repeat(x,[edge_width,layer_length - (2*edge_width),edge_width],axis=1)
-        mid = np.repeat(y,PUNCHOUT_SIZE+edge_width-(corner_box_size), axis=0)
-        z = np.repeat(x,[corner_box_size,(layer_length-(2*edge_width))+edge_width-(corner_box_size),edge_width],axis=1)
-        top = write_cid_text_to_array(corner_box_size, layer_length, upsample[COMPOSITE_MODE], color_tuple, cid)
-        top[0:corner_box_size,0:corner_box_size,:] = color_tuple
-        top[0,:,:] = color_tuple
-        top[:,-1,:] = color_tuple
-        tm = np.append(top,mid, axis=0)
-        return np.append(tm,[top_or_bottom],axis=0)
-
     def black_background(color_space, mult):
         if color_space == 'RGB':
-            return np.zeros((ceil((PAGE_SIZE*mult)/CELLS_PER_ROW)*(PUNCHOUT_SIZE+2),(PUNCHOUT_SIZE+2) * CELLS_PER_ROW, 4))
+            return np.zeros((ceil((PAGE_SIZE*mult)/CELLS_PER_ROW)*(PUNCHOUT_SIZE+2),(PUNCHOUT_SIZE+2) * CELLS_PER_ROW, 4), dtype=np.uint8)
         elif color_space == 'Luminescence':
             return np.zeros((ceil((PAGE_SIZE*mult)/CELLS_PER_ROW)*(PUNCHOUT_SIZE+2),(PUNCHOUT_SIZE+2) * CELLS_PER_ROW))
 
@@ -593,13 +590,93 @@ def change_statuslayer_color(cells):
             if pos in CHANNELS and fluor != 'Composite':
                 if not composite_only: # Only add channels if we are in 'show all' mode. Otherwise only composite will show up
                     if col ==1:
-                        page_status_layer[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),:] = generate_status_box(cell_status, cell_anno +' '+ str(cell_id), composite_only)
+                        paint_status_box(page_status_layer, row, 1, cell_status, cell_anno +' '+ str(cell_id), composite_only)
                     col+=1 # so that next luminescence image is tiled 
                     continue
                 if composite_only: # This stuff is only necessary in composite mode 
-                   page_status_layer[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(cell_status, cell_anno +' '+ str(cell_id), composite_only)
+                   paint_status_box(page_status_layer, row, col, cell_status, cell_anno +' '+ str(cell_id), composite_only)
     # if composite_only:
-    IMAGE_LAYERS['Status'].data = page_status_layer.astype(np.uint8)
+    IMAGE_LAYERS['Status'].data = page_status_layer
+
+def _channel_positions():
+    ''' Positions in the image of the channels being displayed'''
+    return [pos for pos, fluor in enumerate(CHANNEL_ORDER) if pos in CHANNELS and fluor != 'Composite']
+
+def _read_punchouts(centers, positions = None, offset = None, pyramid = None, cancelled = None):
+    ''' Read punchouts for a list of (x,y) centers from whichever image backend is in use'''
+    if positions is None: positions = _channel_positions()
+    if offset is None: offset = int(PUNCHOUT_SIZE/2)
+    if pyramid is None: pyramid = RAW_PYRAMID
+    return punchout_io.extract_page_punchouts(centers, positions, offset,
+                                              pool = SESSION.raster_pool if RASTERS is not None else None,
+                                              pyramid = pyramid, workers = PUNCHOUT_WORKERS, cancelled = cancelled)
+
+def _cache_key(cell, pos):
+    ''' Key for one channel of one cell in the punchout cache'''
+    return (str(cell[0]), int(cell[1]), pos, PUNCHOUT_SIZE, QPTIFF_LAYER_TO_RIP)
+
+def read_page_punchouts(cells, positions, offset, pyramid = None, record = True, cancelled = None):
+    ''' Return a (cells, channels, H, W) uint8 array for a list of [region, id, x, y, ...] cells.
+        Punchouts in the cache are copied from memory, the rest are read from the image and cached.
+        Set record to False to keep background reads out of the cache hit / miss counts. If cancelled()
+        becomes True part way through, the reads stop and nothing is cached.'''
+    size = offset*2
+    punchouts = np.zeros((len(cells), len(positions), size, size), dtype=np.uint8)
+    missing = []
+    for i, cell in enumerate(cells):
+        # A prebuilt gallery pack has every channel for the cell already, no decoding needed
+        slot = GALLERY_PACK.slot(cell[0], cell[1]) if GALLERY_PACK is not None else None
+        if slot is not None and GALLERY_PACK.data.shape[2:] == punchouts.shape[2:]:
+            punchouts[i] = GALLERY_PACK.data[slot, positions]
+            continue
+        complete = True
+        for j, pos in enumerate(positions):
+            cached = PUNCHOUT_CACHE.get(_cache_key(cell, pos), record) if PUNCHOUT_CACHE is not None else None
+            if cached is None or cached.shape != punchouts.shape[2:]:
+                complete = False
+            else:
+                punchouts[i,j] = cached
+        if not complete: missing.append(i)
+    if missing:
+        read = _read_punchouts([(cells[i][2],cells[i][3]) for i in missing], positions, offset, pyramid, cancelled)
+        if cancelled is not None and cancelled(): return punchouts # some windows were skipped, don't cache them
+        punchouts[missing] = read
+        if PUNCHOUT_CACHE is not None:
+            for n, i in enumerate(missing):
+                for j, pos in enumerate(positions):
+                    PUNCHOUT_CACHE.put(_cache_key(cells[i], pos), read[n,j])
+    return punchouts
+
+def _page_rows(page_number, columns, page_size = None):
+    ''' Gather the given columns for the rows on a page of the review order. Only touches the page's rows.'''
+    if page_size is None: page_size = PAGE_SIZE
+    df = userInfo.objectDataFrame
+    positions = REVIEW_ORDER[(page_number-1)*page_size: page_number*page_size]
+    columns = [c for c in columns if c in df.columns]
+    return df.iloc[positions, df.columns.get_indexer(columns)]
+
+def _page_cells(page_number):
+    ''' Return a list of [region, id, x, y] cells for a page of the current review order. Has no
+        side effects, so it is safe to use for pages that are not being shown.'''
+    if REVIEW_ORDER is None or page_number < 1: return []
+    rows = _page_rows(page_number, ["Object Id", "Analysis Region", "XMin", "XMax", "YMin", "YMax"])
+    if rows.empty: return []
+    xs = ((rows['XMax'] + rows['XMin'])/2).astype(int).tolist()
+    ys = ((rows['YMax'] + rows['YMin'])/2).astype(int).tolist()
+    ids = rows['Object Id'].tolist()
+    if ANNOTATIONS_PRESENT:
+        layers = rows['Analysis Region'].tolist()
+    else:
+        layers = ['All'] * len(ids)
+    return [[layer, cid, x, y] for layer, cid, x, y in zip(layers, ids, xs, ys)]
+
+def _prefetch_cells(cells, cancelled):
+    read_page_punchouts(cells, _channel_positions(), int(PUNCHOUT_SIZE/2), record=False, cancelled=cancelled)
+
+def prefetch_neighbouring_pages():
+    ''' Start reading the pages on either side of the current one into the cache in the background'''
+    if PREFETCHER is None: return None
+    PREFETCHER.retarget([_page_cells(CURRENT_PAGE+1), _page_cells(CURRENT_PAGE-1)])
 
 #TODO consider combining numpy arrays before adding layers? So that we create ONE image, and have ONE layer
 #   for the ctc cells. Gallery mode might end up being a pain for downstream.
@@ -610,7 +687,7 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
     print(f"pyramid shape is {pyramid.shape}")
     # Make the color bar that appears to the left of the composite image
     status_colors = STATUS_COLORS
-    global CELLS_PER_ROW, GRID_TO_ID
+    global CELLS_PER_ROW, GRID_TO_ID, STATUS_OVERLAY
     if not composite_only:
         CELLS_PER_ROW = len(CHANNELS_STR) #+1
         # print(f"$$$$$$$ ROW SIZE VS CHANSTR: {CELLS_PER_ROW} vs {len(CHANNELS_STR)}")
@@ -634,72 +711,9 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
             except:
                 raise Exception(f"Looking for {cell_id} in the Status list dict but can't find it. List here:\n {SESSION.status_list}")
 
-    ''' Expects a numpy array of shape PUNCHOUT_SIZE x 16, with a 16x16 box taking up the left-hand side'''    
-    def write_cid_text_to_array(cb_size, im_length, upsample, color, cid):
-        if ABSORPTION: bg_color = (255,255,255,255)
-        else: bg_color = (0,0,0,255)
-        new = Image.new("RGBA", (int(upsample*im_length),int(upsample*cb_size)), bg_color)
-        font = ImageFont.truetype("arial.ttf",48)
-        editable_image = ImageDraw.Draw(new)
-
-        # switch CID order
-        i = cid.split()[-1]; anno = cid.replace(' '+i,'')
-        cid = i + " " + anno
-        editable_image.text((60,1), str(cid), color, font = font)
-        resized = np.array(new.resize((im_length,cb_size), Image.Resampling.LANCZOS))
-        # np.save("lanczos", resized)
-        if ABSORPTION:
-            resized[:,:,0]
-            resized[:,:,3] = (255* (resized[:,:,:3] <200).any(axis=2)).astype(np.uint8)
-            # resized[fade]
-        else:
-            resized[:,:,3] = (255* (resized[:,:,:3] >50).any(axis=2)).astype(np.uint8)
-        return resized
-
-    def generate_status_box(status, cid, composite_only):
-
-        color_tuple = STATUSES_RGBA[status]
-        # print(f'STATUSES {STATUSES_RGBA} \n status {status}, color tup {color_tuple}')
-        
-        upsample = {True : 3.5, False: 3.5 }
-
-        corner_box_size = 16
-        edge_width = 1
-        if composite_only:
-            layer_length = (PUNCHOUT_SIZE+(edge_width*2))
-        else:
-            layer_length = (PUNCHOUT_SIZE+(edge_width*2)) * CELLS_PER_ROW
-
-        if NO_LABEL_BOX:
-            number_only = write_cid_text_to_array(PUNCHOUT_SIZE+(edge_width*2), layer_length, upsample[COMPOSITE_MODE], color_tuple, cid)
-            return number_only
-
-        top_or_bottom = [color_tuple, ] *layer_length
-        # top_or_bottom = np.append([top_or_bottom],[top_or_bottom],axis = 0)
-        x = np.array([[color_tuple, (0,0,0,0), color_tuple]])
-        y = np.repeat(x,[edge_width,layer_length - (2*edge_width),edge_width],axis=1)
-        mid = np.repeat(y,PUNCHOUT_SIZE+edge_width-(corner_box_size), axis=0)
-
-        z = np.repeat(x,[corner_box_size,(layer_length-(2*edge_width))+edge_width-(corner_box_size),edge_width],axis=1)
-        # above_mid = np.repeat(z,corner_box_size-edge_width, axis=0)
-
-        top = write_cid_text_to_array(corner_box_size, layer_length, upsample[COMPOSITE_MODE], color_tuple, cid)
-        # text_added = text_added | above_mid
-        # top = np.append([top_or_bottom],above_mid,axis=0)
-        # print(f"SHAPES: tob {np.array([top_or_bottom]).shape} and text_added {text_added.shape}")
-        # exit()
-        top[0:corner_box_size,0:corner_box_size,:] = color_tuple
-        top[0,:,:] = color_tuple
-        top[:,-1,:] = color_tuple
-
-        # top = np.append([top_or_bottom],text_added,axis=0)
-        # z = np.repeat([np.repeat([0],12)],2,axis=0)z
-        tm = np.append(top,mid, axis=0)
-        return np.append(tm,[top_or_bottom],axis=0)
-
     def black_background(color_space, mult):
         if color_space == 'RGB':
-            return np.zeros((ceil((PAGE_SIZE*mult)/CELLS_PER_ROW)*(PUNCHOUT_SIZE+2),(PUNCHOUT_SIZE+2) * CELLS_PER_ROW, 4))
+            return np.zeros((ceil((PAGE_SIZE*mult)/CELLS_PER_ROW)*(PUNCHOUT_SIZE+2),(PUNCHOUT_SIZE+2) * CELLS_PER_ROW, 4), dtype=np.uint8)
         elif color_space == 'Luminescence':
             return np.zeros((ceil((PAGE_SIZE*mult)/CELLS_PER_ROW)*(PUNCHOUT_SIZE+2),(PUNCHOUT_SIZE+2) * CELLS_PER_ROW))
         
@@ -719,18 +733,21 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
             page_image[chn] = black_background('Luminescence', size_multiplier)
 
     # page_image = black_background('RGB',size_multiplier)
-    page_status_layer = black_background('RGB',size_multiplier)
+    page_status_layer = None if VECTOR_STATUS else black_background('RGB',size_multiplier)
     print(f'Adding {len(cells)} cells to viewer... Channels are {CHANNELS} // {CHANNELS_STR}')
     col = 0
     row = 0
     GRID_TO_ID = {} # Reset this since we could be changing to multichannel mode
     cells = list(cells.values())
+    # Read every (cell, channel) punchout for the page up front, using prefetched data where possible
+    channel_positions = _channel_positions()
+    page_punchouts = read_page_punchouts(cells, channel_positions, offset, pyramid)
     while bool(cells): # coords left
         col = (col%CELLS_PER_ROW)+1
         if col ==1: row+=1 
         # print(f'Next round of while. Still {len(cells)} cells left. Row {row}, Col {col}')
-        cell = cells.pop(); 
-        cell_anno = cell[0]; cell_id = cell[1]; cell_x = cell[2]; cell_y = cell[3]
+        cell = cells.pop(); cell_index = len(cells) # position of this cell in page_punchouts
+        cell_anno = cell[0]; cell_id = cell[1]
         cell_status = retrieve_status(cell_anno +' '+ str(cell_id),cell[4])
         # add the rest of the layers to the viewer
         if RASTERS is not None:
@@ -748,12 +765,7 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
                 #   altering the composite image later (white-in / black-in). 
                 # This is dumb - do it somewhere else
                 # print(f'Testing if raster used: {RASTERS}') # YES can see subdatasets.
-                if RASTERS is not None:
-                    with rasterio.open(RASTERS[pos]) as channel:
-                        cell_punchout = channel.read(1,window=Window(cell_x-offset,cell_y-offset, offset*2,offset*2)).astype(np.uint8)
-                else:
-                    # rasterio reading didn't work, so entire image should be in memory as np array
-                    cell_punchout = pyramid[cell_x-offset:cell_x+offset,cell_y-offset:cell_y+offset,pos].astype(np.uint8)
+                cell_punchout = page_punchouts[cell_index, channel_positions.index(pos)]
                 # print(f'Trying to add {cell_name} layer with fluor-color(cm):{fluor}-{CHANNEL_ORDER[fluor]}')
 
                 # print(f'fluor {fluor} pageimage shape: {pageimage.shape} | row {row}, col {col} | cpsave shape {cp_save.shape}')
@@ -766,8 +778,8 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
                                 (CELLS_PER_ROW-1)*(PUNCHOUT_SIZE+2)+1:CELLS_PER_ROW*(PUNCHOUT_SIZE+2)-1] = cell_punchout
                     GRID_TO_ID[f'{row},{col}'] = cell_anno + ' ' + str(cell_id)
                     GRID_TO_ID[f'{row},{CELLS_PER_ROW}'] = cell_anno + ' ' + str(cell_id)
-                    if col ==1:
-                        page_status_layer[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),:] = generate_status_box(cell_status, cell_anno +' '+ str(cell_id), composite_only)
+                    if col ==1 and not VECTOR_STATUS:
+                        paint_status_box(page_status_layer, row, 1, cell_status, cell_anno +' '+ str(cell_id), composite_only)
 
                     col+=1 # so that next luminescence image is tiled 
                     continue
@@ -775,7 +787,7 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
                 if composite_only: # This stuff is only necessary in composite mode 
                     GRID_TO_ID[f'{row},{col}'] = cell_anno + ' ' + str(cell_id)
                     page_image[fluor][(row-1)*(PUNCHOUT_SIZE+2)+1:row*(PUNCHOUT_SIZE+2)-1, (col-1)*(PUNCHOUT_SIZE+2)+1:col*(PUNCHOUT_SIZE+2)-1] = cell_punchout
-                    page_status_layer[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(cell_status, cell_anno +' '+ str(cell_id), composite_only)
+                    if not VECTOR_STATUS: paint_status_box(page_status_layer, row, col, cell_status, cell_anno +' '+ str(cell_id), composite_only)
     
     print(f"\nMy scale is {SESSION.image_scale}")
     sc = (SESSION.image_scale, SESSION.image_scale) if SESSION.image_scale is not None else None
@@ -792,7 +804,13 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
              IMAGE_LAYERS[fluor] = viewer.add_image(page_image[fluor], name = fluor, 
                                                 blending = 'additive', colormap = custom_maps.retrieve_cm(CHANNEL_ORDER[fluor]), scale = sc)
     # if composite_only:
-    IMAGE_LAYERS['Status'] = viewer.add_image(page_status_layer.astype(np.uint8), name='Status Layer', interpolation='linear', scale = sc)
+    if VECTOR_STATUS:
+        STATUS_OVERLAY = _vector_status_overlay(viewer, composite_only, sc)
+        IMAGE_LAYERS['Status'] = STATUS_OVERLAY.layer
+        forward_viewer_keys()
+    else:
+        STATUS_OVERLAY = None
+        IMAGE_LAYERS['Status'] = viewer.add_image(page_status_layer, name='Status Layer', interpolation='linear', scale = sc)
     status_layer = IMAGE_LAYERS['Status']
 
     ##----------------- Live functions that control mouseover behavior on images 
@@ -881,17 +899,10 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
         cur_status = SESSION.status_list[str(cell_name)]
         cur_index = list(status_colors.keys()).index(cur_status)
         next_status = list(status_colors.keys())[(cur_index+1)%len(status_colors)]
-        SESSION.status_list[str(cell_name)] = next_status
+        SESSION.record_status(str(cell_name), next_status)
         set_notes_label(ALL_CUSTOM_WIDGETS['notes label'], str(cell_name)) 
 
-        imdata = image_layer.data
-        if COMPOSITE_MODE: 
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                              (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_name), True)
-        else:
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                :] = generate_status_box(next_status,str(cell_name), False)
-        image_layer.data = imdata.astype('int')
+        show_status(image_layer, row, col, next_status, str(cell_name))
         # change color of viewer status
         vstatus_list = copy.copy(VIEWER.status).split('>')
         vstatus_list[0] = sub(r'#.{6}',STATUSES_TO_HEX[SESSION.status_list[str(cell_name)]], vstatus_list[0])
@@ -908,21 +919,11 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
 
     def set_all_unseen(image_layer):
         next_status = 'Unseen'
-        imdata = image_layer.data
 
         # set all cells to status
         for coords, cell_id in GRID_TO_ID.items():
-            SESSION.status_list[str(cell_id)] = next_status
-            row = int(coords.split(',')[0])
-            col = int(coords.split(',')[1])
-
-            if COMPOSITE_MODE: 
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                                (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_id), True)
-            else:
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                    :] = generate_status_box(next_status,str(cell_id), False)
-        image_layer.data = imdata.astype('int')
+            SESSION.record_status(str(cell_id), next_status)
+        show_all_statuses(image_layer)
 
         cell_name,data_coordinates,val = find_mouse(image_layer, viewer.cursor.position)
         if val is None:
@@ -948,17 +949,10 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
             return None
         coords = np.round(data_coordinates).astype(int)
         row,col = pixel_coord_to_grid(coords)
-        SESSION.status_list[str(cell_name)] = next_status
+        SESSION.record_status(str(cell_name), next_status)
         set_notes_label(ALL_CUSTOM_WIDGETS['notes label'], str(cell_name)) 
 
-        imdata = image_layer.data
-        if COMPOSITE_MODE: 
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                              (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_name), True)
-        else:
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                :] = generate_status_box(next_status,str(cell_name), False)
-        image_layer.data = imdata.astype('int')
+        show_status(image_layer, row, col, next_status, str(cell_name))
         # change color of viewer status
         vstatus_list = copy.copy(VIEWER.status).split('>')
         vstatus_list[0] = sub(r'#.{6}',STATUSES_TO_HEX[SESSION.status_list[str(cell_name)]], vstatus_list[0])
@@ -966,21 +960,11 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
 
     def set_all_nr(image_layer):
         next_status = 'Needs review'
-        imdata = image_layer.data
 
         # set all cells to status
         for coords, cell_id in GRID_TO_ID.items():
-            SESSION.status_list[str(cell_id)] = next_status
-            row = int(coords.split(',')[0])
-            col = int(coords.split(',')[1])
-
-            if COMPOSITE_MODE: 
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                                (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_id), True)
-            else:
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                    :] = generate_status_box(next_status,str(cell_id), False)
-        image_layer.data = imdata.astype('int')
+            SESSION.record_status(str(cell_id), next_status)
+        show_all_statuses(image_layer)
 
         cell_name,data_coordinates,val = find_mouse(image_layer, viewer.cursor.position)
         if val is None:
@@ -1006,17 +990,10 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
             return None
         coords = np.round(data_coordinates).astype(int)
         row,col = pixel_coord_to_grid(coords)
-        SESSION.status_list[str(cell_name)] = next_status
+        SESSION.record_status(str(cell_name), next_status)
         set_notes_label(ALL_CUSTOM_WIDGETS['notes label'], str(cell_name)) 
 
-        imdata = image_layer.data
-        if COMPOSITE_MODE: 
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                              (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_name), True)
-        else:
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                :] = generate_status_box(next_status,str(cell_name), False)
-        image_layer.data = imdata.astype('int')
+        show_status(image_layer, row, col, next_status, str(cell_name))
         # change color of viewer status
         vstatus_list = copy.copy(VIEWER.status).split('>')
         vstatus_list[0] = sub(r'#.{6}',STATUSES_TO_HEX[SESSION.status_list[str(cell_name)]], vstatus_list[0])
@@ -1024,21 +1001,11 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
 
     def set_all_confirmed(image_layer):
         next_status = 'Confirmed'
-        imdata = image_layer.data
 
         # set all cells to status
         for coords, cell_id in GRID_TO_ID.items():
-            SESSION.status_list[str(cell_id)] = next_status
-            row = int(coords.split(',')[0])
-            col = int(coords.split(',')[1])
-
-            if COMPOSITE_MODE: 
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                                (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_id), True)
-            else:
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                    :] = generate_status_box(next_status,str(cell_id), False)
-        image_layer.data = imdata.astype('int')
+            SESSION.record_status(str(cell_id), next_status)
+        show_all_statuses(image_layer)
 
         cell_name,data_coordinates,val = find_mouse(image_layer, viewer.cursor.position)
         if val is None:
@@ -1064,17 +1031,10 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
             return None
         coords = np.round(data_coordinates).astype(int)
         row,col = pixel_coord_to_grid(coords)
-        SESSION.status_list[str(cell_name)] = next_status
+        SESSION.record_status(str(cell_name), next_status)
         set_notes_label(ALL_CUSTOM_WIDGETS['notes label'], str(cell_name)) 
 
-        imdata = image_layer.data
-        if COMPOSITE_MODE: 
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                              (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_name), True)
-        else:
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                :] = generate_status_box(next_status,str(cell_name), False)
-        image_layer.data = imdata.astype('int')
+        show_status(image_layer, row, col, next_status, str(cell_name))
         # change color of viewer status
         vstatus_list = copy.copy(VIEWER.status).split('>')
         vstatus_list[0] = sub(r'#.{6}',STATUSES_TO_HEX[SESSION.status_list[str(cell_name)]], vstatus_list[0])
@@ -1083,21 +1043,11 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
 
     def set_all_rejected(image_layer):
         next_status = 'Rejected'
-        imdata = image_layer.data
 
         # set all cells to status
         for coords, cell_id in GRID_TO_ID.items():
-            SESSION.status_list[str(cell_id)] = next_status
-            row = int(coords.split(',')[0])
-            col = int(coords.split(',')[1])
-
-            if COMPOSITE_MODE: 
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                                (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_id), True)
-            else:
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                    :] = generate_status_box(next_status,str(cell_id), False)
-        image_layer.data = imdata.astype('int')
+            SESSION.record_status(str(cell_id), next_status)
+        show_all_statuses(image_layer)
 
         cell_name,data_coordinates,val = find_mouse(image_layer, viewer.cursor.position)
         if val is None:
@@ -1123,17 +1073,10 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
             return None
         coords = np.round(data_coordinates).astype(int)
         row,col = pixel_coord_to_grid(coords)
-        SESSION.status_list[str(cell_name)] = next_status
+        SESSION.record_status(str(cell_name), next_status)
         set_notes_label(ALL_CUSTOM_WIDGETS['notes label'], str(cell_name)) 
 
-        imdata = image_layer.data
-        if COMPOSITE_MODE: 
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                              (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_name), True)
-        else:
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                :] = generate_status_box(next_status,str(cell_name), False)
-        image_layer.data = imdata.astype('int')
+        show_status(image_layer, row, col, next_status, str(cell_name))
         # change color of viewer status
         vstatus_list = copy.copy(VIEWER.status).split('>')
         vstatus_list[0] = sub(r'#.{6}',STATUSES_TO_HEX[SESSION.status_list[str(cell_name)]], vstatus_list[0])
@@ -1141,21 +1084,11 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
 
     def set_all_interesting(image_layer):
         next_status = 'Interesting'
-        imdata = image_layer.data
 
         # set all cells to status
         for coords, cell_id in GRID_TO_ID.items():
-            SESSION.status_list[str(cell_id)] = next_status
-            row = int(coords.split(',')[0])
-            col = int(coords.split(',')[1])
-
-            if COMPOSITE_MODE: 
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                                (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_id), True)
-            else:
-                imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                    :] = generate_status_box(next_status,str(cell_id), False)
-        image_layer.data = imdata.astype('int')
+            SESSION.record_status(str(cell_id), next_status)
+        show_all_statuses(image_layer)
 
         cell_name,data_coordinates,val = find_mouse(image_layer, viewer.cursor.position)
         if val is None:
@@ -1181,24 +1114,18 @@ def add_layers(viewer,pyramid, cells, offset, composite_only=COMPOSITE_MODE, new
             return None
         coords = np.round(data_coordinates).astype(int)
         row,col = pixel_coord_to_grid(coords)
-        SESSION.status_list[str(cell_name)] = next_status
+        SESSION.record_status(str(cell_name), next_status)
         set_notes_label(ALL_CUSTOM_WIDGETS['notes label'], str(cell_name)) 
 
-        imdata = image_layer.data
-        if COMPOSITE_MODE: 
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2), 
-                              (col-1)*(PUNCHOUT_SIZE+2):col*(PUNCHOUT_SIZE+2)] = generate_status_box(next_status,str(cell_name), True)
-        else:
-            imdata[(row-1)*(PUNCHOUT_SIZE+2):row*(PUNCHOUT_SIZE+2),
-                :] = generate_status_box(next_status,str(cell_name), False)
-        image_layer.data = imdata.astype('int')
+        show_status(image_layer, row, col, next_status, str(cell_name))
         # change color of viewer status
         vstatus_list = copy.copy(VIEWER.status).split('>')
         vstatus_list[0] = sub(r'#.{6}',STATUSES_TO_HEX[SESSION.status_list[str(cell_name)]], vstatus_list[0])
         VIEWER.status = ">".join(vstatus_list)
 
     #TODO make a page label... 
-
+    if PUNCHOUT_CACHE is not None and 'cache label' in ALL_CUSTOM_WIDGETS:
+        ALL_CUSTOM_WIDGETS['cache label'].setText(PUNCHOUT_CACHE.summary()) # not the status bar, mouse moves overwrite that
     return True
 
 ######------------------------- Misc + Viewer keybindings ---------------------######
@@ -1221,22 +1148,114 @@ def add_custom_colors():
         exec(f'cm.register_cmap(name = "{colormap}", cmap = custom)')
     return True
 
+class _SaveThread(QThread):
+    ''' Runs the file-writing half of a save. The disk lock is already held when this starts.'''
+    def __init__(self, presets, progress_signal, export = False) -> None:
+        super().__init__()
+        self.presets = presets
+        self.progress_signal = progress_signal
+        self.export = export
+        self.result = False
+
+    def run(self):
+        total = max(len(self.presets.session.write_snapshot.index), 1) # the table itself keeps changing on the GUI thread
+        def report(rows):
+            self.progress_signal.emit(f'Saving ... {100*rows/total:.0f}%')
+        try:
+            self.result = self.presets.finish_disk_write(progress = report, export = self.export)
+        except Exception as e:
+            print(f'Save failed: {e}')
+            self.result = False
+
+class BackgroundSaver(QObject):
+    ''' Writes decisions to the object data file on a worker thread, so scoring never waits on the disk.
+    Requests that arrive within the debounce window (or while a write is running) are coalesced into
+    one write. The pending decisions are folded into the table on the GUI thread when the write
+    starts; the worker writes that snapshot. A failed write keeps everything in memory and in the
+    journal, and is retried by the next request.'''
+    progress = pyqtSignal(str)
+
+    def __init__(self, presets, debounce_ms = 750) -> None:
+        super().__init__()
+        self.presets = presets
+        self.debounce_ms = debounce_ms
+        self.queued = False
+        self.export_queued = False # In sidecar mode, whether the queued write should also merge decisions into the .csv
+        self.worker = None
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self._start)
+        self.progress.connect(self._show_progress)
+
+    def request(self, immediate = False, export = False):
+        ''' Ask for a save. Repeated requests restart the debounce timer, so a burst becomes one write.
+            export asks for the .csv to be written too, when decisions are kept in a sidecar.'''
+        self.queued = True
+        self.export_queued = self.export_queued or export
+        self.timer.start(0 if immediate else self.debounce_ms)
+
+    def busy(self):
+        return self.worker is not None and self.worker.isRunning()
+
+    def _start(self):
+        if not self.queued or self.busy():
+            return None # a running write picks this up when it finishes
+        if not self.presets.begin_disk_write(blocking=False):
+            self.timer.start(self.debounce_ms) # some other write holds the file, try again shortly
+            return None
+        self.queued = False
+        self.worker = _SaveThread(self.presets, self.progress, export = self.export_queued)
+        self.export_queued = False
+        self.worker.finished.connect(self._finished)
+        self.worker.start()
+
+    def _show_progress(self, text):
+        if VIEWER is not None: VIEWER.status = text
+
+    def _finished(self):
+        if self.worker.result:
+            self._show_progress('Done exporting!' if self.worker.export else 'Done saving!')
+        else:
+            self.export_queued = self.export_queued or self.worker.export # try the export again with the next write
+            self._show_progress('There was a problem saving. Close your data file? Your decisions are kept and will be saved next time.')
+        if self.queued: self.timer.start(self.debounce_ms)
+
+    def shutdown(self):
+        ''' Stop taking requests and wait for a running write to finish'''
+        self.timer.stop()
+        if self.worker is not None: self.worker.wait()
+
+def bind_viewer_key(viewer, key):
+    ''' viewer.bind_key that also records the binding in VIEWER_KEY_ACTIONS, so forward_viewer_keys can pass it on'''
+    def register(func):
+        VIEWER_KEY_ACTIONS[key] = func
+        return viewer.bind_key(key)(func)
+    return register
+
+def forward_viewer_keys():
+    ''' The active layer gets a key before the viewer, and a shapes layer claims several of the viewer's keys
+        for itself (drawing modes on s, a, r, i and the digits, depending on the napari version). Bind every
+        viewer key on the vector status layer too, so it does what the viewer binding does.'''
+    if STATUS_OVERLAY is None: return None
+    for key in VIEWER_KEY_ACTIONS:
+        STATUS_OVERLAY.layer.bind_key(key, lambda layer, key=key: VIEWER_KEY_ACTIONS[key](VIEWER), overwrite=True)
+
 def sv_wrapper(viewer):
-    @viewer.bind_key('s')
+    @bind_viewer_key(viewer, 's')
     def save_validation(viewer):
-        print(f'Using stored dataframe')
         viewer.status = 'Saving ...'
-        # try:
-        res = userInfo._save_validation(to_disk=True)
-        
-        if res: 
-            viewer.status = 'Done saving!'
-        else:
-            viewer.status = 'There was a problem. Close your data file?'
+        SAVER.request(immediate=True) # written in the background, the status bar shows progress
+        return None
+
+    @bind_viewer_key(viewer, 'Shift-s')
+    def export_validation(viewer):
+        ''' In sidecar mode, saves only touch the sidecar. This merges the decisions into the object data .csv'''
+        viewer.status = 'Exporting decisions to the object data file ...'
+        SAVER.request(immediate=True, export=True)
         return None
 
 def tsv_wrapper(viewer):
-    @viewer.bind_key('h')
+    @bind_viewer_key(viewer, 'h')
     def toggle_statuslayer_visibility(viewer):
         show_vis_radio = ALL_CUSTOM_WIDGETS['show status layer radio']
         hide_vis_radio = ALL_CUSTOM_WIDGETS['hide status layer radio']
@@ -1247,7 +1266,7 @@ def tsv_wrapper(viewer):
             show_vis_radio.setChecked(True)
             hide_vis_radio.setChecked(False)
 
-    @viewer.bind_key('Control-h')
+    @bind_viewer_key(viewer, 'Control-h')
     def toggle_statusbox_visibility(viewer):
         show_box_radio = ALL_CUSTOM_WIDGETS['show status box radio']
         hide_box_radio = ALL_CUSTOM_WIDGETS['hide status box radio']
@@ -1258,27 +1277,27 @@ def tsv_wrapper(viewer):
             show_box_radio.setChecked(True)
             hide_box_radio.setChecked(False)
 
-    @viewer.bind_key('Control-k')
+    @bind_viewer_key(viewer, 'Control-k')
     def restore_canvas(viewer):
         set_viewer_to_neutral_zoom(viewer)
 
-    @viewer.bind_key('k')
+    @bind_viewer_key(viewer, 'k')
     def recenter_canvas(viewer):
         set_viewer_to_neutral_zoom(viewer)
 
-    @viewer.bind_key('Up')
+    @bind_viewer_key(viewer, 'Up')
     def scroll_up(viewer):
         z,y,x = viewer.camera.center
         sc = 1 if SESSION.image_scale is None else SESSION.image_scale
         viewer.camera.center = (y-((PUNCHOUT_SIZE+2)*sc),x)
 
-    @viewer.bind_key('Down')
+    @bind_viewer_key(viewer, 'Down')
     def scroll_down(viewer):
         z,y,x = viewer.camera.center
         sc = 1 if SESSION.image_scale is None else SESSION.image_scale
         viewer.camera.center = (y+((PUNCHOUT_SIZE+2)*sc),x)
     
-    @viewer.bind_key('Left')
+    @bind_viewer_key(viewer, 'Left')
     def scroll_left(viewer):
         z,y,x = viewer.camera.center
         sc = 1 if SESSION.image_scale is None else SESSION.image_scale
@@ -1288,39 +1307,39 @@ def tsv_wrapper(viewer):
         # viewer.window.qt_viewer.canvas.events.mouse_press(pos=(x, y), modifiers=(), button=0)
         # viewer.cursor.position = viewer.window.qt_viewer._map_canvas2world([x,y])
 
-    @viewer.bind_key('Right')   
+    @bind_viewer_key(viewer, 'Right')   
     def scroll_right(viewer):
         z,y,x = viewer.camera.center
         sc = 1 if SESSION.image_scale is None else SESSION.image_scale
         viewer.camera.center = (y,x+((PUNCHOUT_SIZE+2)*sc))
 
     # On Macs, ctrl-arrow key is taken by something else.
-    @viewer.bind_key('Shift-Right')  
-    @viewer.bind_key('Shift-Up') 
-    @viewer.bind_key('Control-Right')  
-    @viewer.bind_key('Control-Up')   
+    @bind_viewer_key(viewer, 'Shift-Right')  
+    @bind_viewer_key(viewer, 'Shift-Up') 
+    @bind_viewer_key(viewer, 'Control-Right')  
+    @bind_viewer_key(viewer, 'Control-Up')   
     def zoom_in(viewer):
         viewer.camera.zoom *= 1.15
 
-    @viewer.bind_key('Shift-Left')  
-    @viewer.bind_key('Shift-Down') 
-    @viewer.bind_key('Control-Left')  
-    @viewer.bind_key('Control-Down')   
+    @bind_viewer_key(viewer, 'Shift-Left')  
+    @bind_viewer_key(viewer, 'Shift-Down') 
+    @bind_viewer_key(viewer, 'Control-Left')  
+    @bind_viewer_key(viewer, 'Control-Down')   
     def zoom_out(viewer):
         viewer.camera.zoom /= 1.15  
     
-    @viewer.bind_key('a')
+    @bind_viewer_key(viewer, 'a')
     def trigger_absorption(viewer):
         toggle_absorption()
     
-    @viewer.bind_key('r')
+    @bind_viewer_key(viewer, 'r')
     def reset_viewsettings(viewer):
         global ADJUSTMENT_SETTINGS
         ADJUSTMENT_SETTINGS = copy.copy(ORIGINAL_ADJUSTMENT_SETTINGS)
         reuse_gamma()
         reuse_contrast_limits()
     
-    @viewer.bind_key('i')
+    @bind_viewer_key(viewer, 'i')
     def toggle_interpolation(viewer):
         current = IMAGE_LAYERS[CHANNELS_STR[0]].interpolation
         if current == 'nearest':
@@ -1331,7 +1350,7 @@ def tsv_wrapper(viewer):
             if fluor =='Composite': continue
             IMAGE_LAYERS[fluor].interpolation = new
 
-    @viewer.bind_key('Alt-m')
+    @bind_viewer_key(viewer, 'Alt-m')
     def open_guide(viewer):
         os.startfile(os.path.normpath(os.curdir+ r"/data/GalleryViewer v{x} User Guide.pdf".format(x=VERSION_NUMBER)))
         
@@ -1340,7 +1359,7 @@ def tsv_wrapper(viewer):
 
 def chn_key_wrapper(viewer):
     def create_fun(position,channel):
-        @viewer.bind_key(str(position+1))
+        @bind_viewer_key(viewer, str(position+1))
         def toggle_channel_visibility(viewer,pos=position,chn=channel):
             # widget_name = chn+'_box'
             # print(f'You are trying to toggle {widget_name} with pos {pos}')
@@ -1366,18 +1385,57 @@ def set_initial_adjustment_parameters(viewsettings):
 
     return True
 
-def fetch_notes(cell_row, intensity_col_names):
-    '''Grab notes and intensities for each cell in the list and save to global dicts'''
-    if not ANNOTATIONS_PRESENT:
-        ID = "All " + str(cell_row['Object Id'])
+def _compute_review_order(df, phenotypes, annotations):
+    ''' Return the row positions of the cells to review, in global sort order. Keeps a cell if it is
+        positive for any phenotype in the list or a member of any annotation layer in the list.'''
+    bitmaps = userInfo.objectDataBitmaps
+    if bitmaps is None or bitmaps.n_rows != len(df.index):
+        bitmaps = userInfo.objectDataBitmaps = object_data.MembershipBitmaps.from_table(df, userInfo.objectDataSchema)
+    for pheno in phenotypes:
+        if pheno not in bitmaps.phenotypes: # a column the schema didn't take for a phenotype
+            bitmaps.phenotypes[pheno] = np.packbits((df[pheno] == 1).to_numpy())
+    if annotations or phenotypes:
+        positions = np.flatnonzero(bitmaps.mask(bitmaps.any_of(phenotypes = phenotypes, regions = annotations)))
     else:
-        ID = str(cell_row['Analysis Region']) + ' ' + str(cell_row['Object Id'])
-    SESSION.saved_notes[ID] = cell_row['Notes']
-    # Find out which columns are present in the Series and subset to those
-    present_intensities = sorted(list(set(list(cell_row.index)).intersection(set(intensity_col_names))))
-    cell_row = cell_row.loc[present_intensities]
-    SAVED_INTENSITIES[ID] = cell_row
-    # print(f'dumping dict {SESSION.saved_notes}')
+        positions = np.arange(len(df.index))
+
+    if GLOBAL_SORT is not None:
+        # Highest first, ties stay in file order (same as a descending mergesort)
+        values = df[GLOBAL_SORT].to_numpy(dtype=float)[positions]
+        positions = positions[np.argsort(-values, kind='stable')]
+    elif annotations:
+        keys = df.iloc[positions, df.columns.get_indexer(["Analysis Region","Object Id"])].reset_index(drop=True)
+        positions = positions[keys.sort_values(by = ["Analysis Region","Object Id"], ascending = True, kind = 'mergesort').index.to_numpy()]
+    return positions
+
+def _lookup_key(code, cid):
+    return np.int64(code) * 2**32 + np.int64(cid)
+
+def _build_review_lookup(df):
+    ''' Index the cells in REVIEW_ORDER by (Analysis Region, Object Id) so they can be found without a scan'''
+    global REVIEW_LOOKUP, REVIEW_REGION_CODES
+    ids = df['Object Id'].to_numpy(dtype=np.int64)[REVIEW_ORDER]
+    if ANNOTATIONS_PRESENT:
+        regions = pd.Categorical(df['Analysis Region'].to_numpy()[REVIEW_ORDER].astype(str))
+        REVIEW_REGION_CODES = {name: code for code, name in enumerate(regions.categories)}
+        codes = regions.codes.astype(np.int64)
+    else:
+        REVIEW_REGION_CODES = {'All': 0}
+        codes = np.zeros(len(ids), dtype=np.int64)
+    REVIEW_LOOKUP = pd.Index(_lookup_key(codes, ids))
+
+def review_position(layer, cid):
+    ''' Return the position of a cell in REVIEW_ORDER, or None if it isn't one of the cells under review'''
+    if REVIEW_LOOKUP is None: return None
+    code = REVIEW_REGION_CODES.get(str(layer))
+    if code is None: return None
+    try:
+        pos = REVIEW_LOOKUP.get_loc(_lookup_key(code, int(cid)))
+    except (KeyError, ValueError):
+        return None
+    if isinstance(pos, slice): return pos.start # Duplicate cell names, use the first one
+    if isinstance(pos, np.ndarray): return int(np.flatnonzero(pos)[0])
+    return int(pos)
 
 '''Get object data from csv and parse.''' 
 def extract_phenotype_xldata(page_size=None, phenotypes=None,annotations = None, page_number = 1, 
@@ -1397,16 +1455,16 @@ def extract_phenotype_xldata(page_size=None, phenotypes=None,annotations = None,
     if phenotypes is None: phenotypes=PHENOTYPES
     if annotations is None: annotations=ANNOTATIONS  # Name of phenotype of interest
     # print(f'ORDERING PARAMS: id start: {cell_id_start}, page size: {page_size}, direction: {direction}, change?: {change_startID}')
-    halo_export = userInfo.objectDataFrame.copy()
+    halo_export = userInfo.objectDataFrame # Not copied. Pages are gathered from it by row position
 
     # Check for errors:
     for ph in phenotypes:
-        if ph not in list(halo_export.columns):
+        if ph not in halo_export.columns:
             raise KeyError
-    if len(annotations) >0 and ('Analysis Region' not in list(halo_export.columns)):
+    if len(annotations) >0 and ('Analysis Region' not in halo_export.columns):
         raise KeyError
 
-    # Add columns w/defaults if they aren't there to avoid runtime issues
+    # Add columns w/defaults if they aren't there to avoid runtime issues. Saving would add the same ones
     if "Validation | Unseen" not in halo_export.columns:
         for call_type in reversed(STATUS_COLORS.keys()):
             if call_type == 'Unseen':
@@ -1415,59 +1473,42 @@ def extract_phenotype_xldata(page_size=None, phenotypes=None,annotations = None,
                 halo_export.insert(8,f"Validation | {call_type}", 0)     
     if "Notes" not in halo_export.columns:
         halo_export.insert(8,"Notes","-")
-        halo_export.fillna("")
 
     # Get relevant columns for intensity sorting
     # TODO make this conditional, and in a try except format
-    headers = pd.read_csv(OBJECT_DATA_PATH, index_col=False, nrows=0).columns.tolist() 
-    possible_fluors = ['DAPI','Opal 480','Opal 520', 'Opal 570', 'Opal 620','Opal 690', 'Opal 720', 'AF', 'Sample AF', 'Autofluorescence']
-    suffixes = ['Cell Intensity','Nucleus Intensity', 'Cytoplasm Intensity']
-    all_possible_intensities = [x for x in headers if (any(s in x for s in suffixes) and (any(f in x for f in possible_fluors)))]
+    if userInfo.objectDataSchema is None: # Found once when the data was read
+        userInfo.objectDataSchema = object_data.build_schema(userInfo.objectDataFrame)
+    all_possible_intensities = userInfo.objectDataSchema.intensity_columns
     # for fl in possible_fluors:
     #         for sf in suffixes:
     #             all_possible_intensities.append(f'{fl} {sf}')
     v = list(STATUS_COLORS.keys())
     validation_cols = [f"Validation | " + s for s in v]
     cols_to_keep = ["Object Id","Analysis Region", "Notes", "XMin","XMax","YMin", "YMax"] + phenotypes + all_possible_intensities + validation_cols
-    cols_to_keep = halo_export.columns.intersection(cols_to_keep)
-    halo_export = halo_export.loc[:, cols_to_keep]
 
     global GLOBAL_SORT
     global_sort_status = True
     if GLOBAL_SORT is not None:
         try:
             GLOBAL_SORT = [x for x in all_possible_intensities if all(y in x for y in GLOBAL_SORT.split(" "))][0]
-            halo_export = halo_export.sort_values(by = GLOBAL_SORT, ascending = False, kind = 'mergesort')
-        except:
+        except IndexError:
             print('Global sort failed. Will sort by Cell Id instead.')
             GLOBAL_SORT = None
             global_sort_status = False
             VIEWER.status = 'Global sort failed. Will sort by Cell Id instead.'
-            if annotations:
-                halo_export = halo_export.sort_values(by = ["Analysis Region","Object Id"], ascending = True, kind = 'mergesort')
-    else:
-        if annotations:
-            halo_export = halo_export.sort_values(by = ["Analysis Region","Object Id"], ascending = True, kind = 'mergesort')
-    
-    # Helper to construct query string that will subset dataframe down to cells that 
-    #   are positive for a phenotype in the list, or a member of an annotation layer in the list
-    def _create_anno_pheno_query(anno_list, pheno_list):
-        query = ''
-        for anno in anno_list:
-            query += f"(`Analysis Region` == '{anno}') | "
-        for pheno in pheno_list:
-            query += f"(`{pheno}` == 1) |"
-        print(query)
-        return query.rstrip(" |")
+
+    # The filtered + sorted order only depends on these, so it is computed once and reused for every page
+    global REVIEW_ORDER, REVIEW_ORDER_KEY
+    order_key = (tuple(phenotypes), tuple(annotations), GLOBAL_SORT, len(halo_export.index))
+    if REVIEW_ORDER is None or REVIEW_ORDER_KEY != order_key:
+        REVIEW_ORDER = _compute_review_order(halo_export, phenotypes, annotations)
+        REVIEW_ORDER_KEY = order_key
+        _build_review_lookup(halo_export)
 
     # #acquire 
     print('page code start')
     # Figure out which range of cells to get based on page number and size
-    if annotations or phenotypes:
-        phen_only_df = halo_export.query(_create_anno_pheno_query(annotations,phenotypes)).reset_index()
-    else:
-        phen_only_df = halo_export.reset_index()
-    last_page = (len(phen_only_df.index) // page_size)+1
+    last_page = (len(REVIEW_ORDER) // page_size)+1
     print(f"last page is {last_page}")
     global ALL_CUSTOM_WIDGETS
     combobox_widget =  ALL_CUSTOM_WIDGETS['page combobox']
@@ -1486,24 +1527,27 @@ def extract_phenotype_xldata(page_size=None, phenotypes=None,annotations = None,
             specific_layer = specific_cell['Annotation Layer']
             
             if ANNOTATIONS_PRESENT and specific_layer:
-                singlecell_df = phen_only_df[(phen_only_df['Object Id']==int(specific_cid)) & (phen_only_df['Analysis Region']==str(specific_layer))]
-            else:
-                singlecell_df = phen_only_df[phen_only_df['Object Id']==int(specific_cid)]
-            sc_index = singlecell_df.index[0]
-            page_number = (sc_index//page_size) + 1
-            #TODO set the combobox widget to the current page number
+                sc_index = review_position(specific_layer, specific_cid)
+            elif not ANNOTATIONS_PRESENT:
+                sc_index = review_position('All', specific_cid)
+            else: # No layer given, so take the first cell with this ID in any layer
+                ids = halo_export['Object Id'].to_numpy()[REVIEW_ORDER]
+                sc_index = np.flatnonzero(ids == int(specific_cid))[0]
+            if sc_index is None: raise KeyError(specific_cid)
+            page_number = (sc_index//page_size) + 1 # The combobox is set to this below
         except (KeyError,IndexError, ValueError):
             print(f'The cell ID {specific_layer} {specific_cid} is not in my list of cells. Loading default page instead')
             VIEWER.status = f'The cell ID {specific_layer} {specific_cid} is not in my list of cells. Loaded default page instead'
 
+    # Remember where we are so that the neighbouring pages can be prefetched
+    global CURRENT_PAGE
+    CURRENT_PAGE = page_number
+
     # set widget to current page number 
     combobox_widget.setCurrentIndex(page_number-1)
     SESSION.saved_notes['page'] = combobox_widget.currentText()
-    # Get the appropriate set
-    if page_number != last_page:
-        cell_set = phen_only_df[(page_number-1)*page_size: page_number*page_size]
-    else:
-        cell_set = phen_only_df[(page_number-1)*page_size:]
+    # Get the appropriate set. Only this page's rows are gathered from the table
+    cell_set = _page_rows(page_number, cols_to_keep, page_size)
     
     print(f"#$%#$% local sort is {sort_by_intensity}")
 
@@ -1530,28 +1574,49 @@ def extract_phenotype_xldata(page_size=None, phenotypes=None,annotations = None,
                 cell_set = cell_set.sort_values(by = ["Analysis Region",'Object Id'], ascending = False, kind = 'mergesort')
             else:
                 cell_set = cell_set.sort_values(by = 'Object Id', ascending = False, kind = 'mergesort')
-    tumor_cell_XYs = {}
-    try:
-        for index,row in cell_set.iterrows():
-            fetch_notes(row, all_possible_intensities)
-            center_x = int((row['XMax']+row['XMin'])/2)
-            center_y = int((row['YMax']+row['YMin'])/2)
-            vals = row[validation_cols]
-            validation_call = str(vals[vals == 1].index.values[0]).replace(f"Validation | ", "")
-            cid = row["Object Id"]
-            if ANNOTATIONS_PRESENT:
-                layer = row["Analysis Region"]
-                tumor_cell_XYs[f'{layer} {cid}'] = [layer, cid, center_x, center_y, validation_call]
-            else:
-                tumor_cell_XYs[f'All {cid}'] = ['All', cid, center_x, center_y, validation_call]
-    except Exception as e:
-        print("FOUND IT!")
-        print(e)
-        exit()
+    # Build the whole page column-wise
+    ids = cell_set['Object Id'].astype(int).tolist()
+    if ANNOTATIONS_PRESENT:
+        layers = cell_set['Analysis Region'].tolist()
+    else:
+        layers = ['All'] * len(ids)
+    keys = [f'{layer} {cid}' for layer, cid in zip(layers, ids)]
+    centers_x = ((cell_set['XMax'] + cell_set['XMin'])/2).astype(int).tolist()
+    centers_y = ((cell_set['YMax'] + cell_set['YMin'])/2).astype(int).tolist()
+    # Each row should have a single 1 among the validation columns. Its position is the status.
+    #   Rows without one (e.g. all zeros) get the default status
+    present_calls = [c for c in validation_cols if c in cell_set.columns]
+    is_call = cell_set[present_calls].to_numpy() == 1
+    has_call = is_call.any(axis=1) if present_calls else np.zeros(len(ids), dtype=bool)
+    status_codes = is_call.argmax(axis=1) if present_calls else np.zeros(len(ids), dtype=np.intp)
+    calls = [present_calls[code].replace("Validation | ", "") if found else 'Unseen' for code, found in zip(status_codes, has_call)]
+    SESSION.saved_notes.update(zip(keys, cell_set['Notes'].tolist()))
+    global INTENSITY_MAP, PAGE_INTENSITIES, PAGE_CELL_ROWS
+    if INTENSITY_MAP is None:
+        INTENSITY_MAP = userInfo.objectDataSchema.intensity_map(list(CHANNEL_ORDER.keys()))
+    PAGE_INTENSITIES = INTENSITY_MAP.gather(cell_set)
+    PAGE_CELL_ROWS = {key: i for i, key in enumerate(keys)}
+    tumor_cell_XYs = {key: [layer, cid, x, y, call] for key, layer, cid, x, y, call
+                        in zip(keys, layers, ids, centers_x, centers_y, calls)}
     global XY_STORE
     XY_STORE = copy.copy(tumor_cell_XYs)
     return tumor_cell_XYs
 
+def _load_cell_from_table(cell_name):
+    ''' Put a cell's saved note and status into the session so that it can be edited. Raises KeyError if
+        the cell isn't one of the cells under review.'''
+    layer, _, cid = cell_name.rpartition(' ') # only the trailing id, region names can hold numbers too
+    pos = review_position(layer, cid)
+    if pos is None: raise KeyError(cell_name)
+    df = userInfo.objectDataFrame
+    row = df.iloc[REVIEW_ORDER[pos]]
+    SESSION.saved_notes[cell_name] = row['Notes'] if 'Notes' in df.columns else '-'
+    if cell_name not in SESSION.status_list:
+        status = "Unseen"
+        for call_type in STATUS_COLORS.keys():
+            if row.get(f"Validation | {call_type}") == 1: status = call_type
+        SESSION.status_list[cell_name] = status
+
 def replace_note(cell_widget, note_widget):
     cellID = cell_widget.text(); note = note_widget.text()
     # try: 
@@ -1559,9 +1624,12 @@ def replace_note(cell_widget, note_widget):
     # except ValueError:
     #     VIEWER.status = 'Error recording note: non-numeric Cell Id given'
     #     return None 
+    if not ANNOTATIONS_PRESENT and cellID.strip().isdigit():
+        cellID = f'All {cellID.strip()}' # Names are stored with the layer they came from
     try:
-        SESSION.saved_notes[str(cellID)] # to trigger exception
-        SESSION.saved_notes[str(cellID)] = note
+        if str(cellID) not in SESSION.saved_notes:
+            _load_cell_from_table(str(cellID)) # A cell that isn't on a page that's been shown yet
+        SESSION.record_note(str(cellID), note)
         cell_widget.clear(); note_widget.clear()
         VIEWER.status = "Note recorded! Press 's' to save to file."
     except KeyError as e:
@@ -1574,7 +1642,7 @@ def replace_note(cell_widget, note_widget):
 def GUI_execute(preprocess_class):
     global userInfo, qptiff, PUNCHOUT_SIZE, PAGE_SIZE, CHANNELS_STR, CHANNEL_ORDER, STATUS_COLORS, STATUSES_TO_HEX, STATUSES_RGBA
     global CHANNELS, ADJUSTED, OBJECT_DATA_PATH, PHENOTYPES, ANNOTATIONS, SPECIFIC_CELL, GLOBAL_SORT, CELLS_PER_ROW
-    global ANNOTATIONS_PRESENT, ORIGINAL_ADJUSTMENT_SETTINGS, SESSION
+    global ANNOTATIONS_PRESENT, ORIGINAL_ADJUSTMENT_SETTINGS, SESSION, PUNCHOUT_WORKERS, INTENSITY_MAP, VECTOR_STATUS
     userInfo = preprocess_class.userInfo ; status_label = preprocess_class.status_label
     SESSION = userInfo.session
 
@@ -1588,8 +1656,11 @@ def GUI_execute(preprocess_class):
     SPECIFIC_CELL = userInfo.specific_cell
     OBJECT_DATA_PATH = userInfo.objectDataPath
     CELLS_PER_ROW = userInfo.cells_per_row
+    PUNCHOUT_WORKERS = getattr(userInfo, 'punchout_workers', None) or punchout_io.DEFAULT_WORKERS # older presets won't have this
+    VECTOR_STATUS = getattr(userInfo, 'vector_status_layer', False)
     CHANNEL_ORDER = userInfo.channelOrder
     if "Composite" not in list(CHANNEL_ORDER.keys()): CHANNEL_ORDER['Composite'] = 'None'
+    INTENSITY_MAP = None # Resolved against the new channels when the first page is read
     CHANNELS = []
     CHANNELS_STR = []
     for pos,chn in enumerate(list(CHANNEL_ORDER.keys())):
@@ -1616,7 +1687,7 @@ def GUI_execute(preprocess_class):
 def main(preprocess_class = None):
     #TODO do this in a function because this is ugly
 
-    global RAW_PYRAMID, RASTERS, VIEWER, ALL_CUSTOM_WIDGETS
+    global RAW_PYRAMID, RASTERS, VIEWER, ALL_CUSTOM_WIDGETS, PREFETCHER, PUNCHOUT_CACHE, GALLERY_PACK, SAVER
     if preprocess_class is not None: preprocess_class.status_label.setVisible(True)
     preprocess_class._append_status_br("Loading image as raster...")
     start_time = time.time()
@@ -1628,15 +1699,8 @@ def main(preprocess_class = None):
             pyramid = src
             raw_subdata = copy.copy(src.subdatasets)
         # Remove overview pic and label pic from subdataset. Some other crap at the end too?  
-        #   They happen to be in the middle of the set, and aren't really well labelled.
-        to_remove = []
-        for i,sds in enumerate(raw_subdata):
-            # These are the IDS of the crap data.
-            if sds.replace('GTIFF_DIR:','')[1].isdigit() or sds.replace('GTIFF_DIR:','').startswith('9'):  
-                to_remove.append(sds)  
-        for sds in to_remove:
-            raw_subdata.remove(sds)
-        RASTERS = raw_subdata
+        RASTERS = punchout_io.filter_subdatasets(raw_subdata)
+        SESSION.raster_pool = punchout_io.RasterPool(RASTERS) # Datasets are opened once, then reused for every punchout
 
         preprocess_class._append_status('<font color="#7dbc39">  Done.</font>')
         preprocess_class._append_status_br('Sorting object data...')
@@ -1670,6 +1734,9 @@ def main(preprocess_class = None):
     finally:
         end_time = time.time()
         print(f'... completed in {end_time-start_time} seconds')
+    GALLERY_PACK = punchout_io.GalleryPack.find(OBJECT_DATA_PATH, qptiff, PUNCHOUT_SIZE, QPTIFF_LAYER_TO_RIP, object_table=userInfo.objectDataFrame)
+    if GALLERY_PACK is not None:
+        print(f'Serving cells from a gallery pack of {len(GALLERY_PACK.rows)} cells')
 
     
     viewer = napari.Viewer(title=f'GalleryViewer v{VERSION_NUMBER} {SESSION.image_display_name}')
@@ -1711,16 +1778,17 @@ def main(preprocess_class = None):
         intensity_sort_box.setCurrentText(f"Sort page by Sample {local_sort} Intensity")
 
     next_page_button = QPushButton("Change Page")
+    cache_label = QLabel(); cache_label.setWordWrap(True) # punchout cache hits / misses, updated with each page
 
     notes_container = viewer.window.add_dock_widget([notes_label,note_text_entry, note_cell_entry, note_button], name = 'Annotation', area = 'right')
     # Don't include annotation combobox unless it is necessary
     if ANNOTATIONS_PRESENT:
         page_cell_combo = QComboBox(); page_cell_combo.addItems(ANNOTATIONS_PRESENT); page_cell_combo.setFixedWidth(200)
         next_page_button.pressed.connect(lambda: show_next_cell_group(page_combobox, page_cell_entry,page_cell_combo, intensity_sort_box))
-        page_container = viewer.window.add_dock_widget([page_combobox,page_cell_entry, page_cell_combo, intensity_sort_box, next_page_button], name = 'Page selection', area = 'right')
+        page_container = viewer.window.add_dock_widget([page_combobox,page_cell_entry, page_cell_combo, intensity_sort_box, next_page_button, cache_label], name = 'Page selection', area = 'right')
     else:
         next_page_button.pressed.connect(lambda: show_next_cell_group(page_combobox, page_cell_entry, None, intensity_sort_box))
-        page_container = viewer.window.add_dock_widget([page_combobox,page_cell_entry, intensity_sort_box, next_page_button], name = 'Page selection', area = 'right')
+        page_container = viewer.window.add_dock_widget([page_combobox,page_cell_entry, intensity_sort_box, next_page_button, cache_label], name = 'Page selection', area = 'right')
 
 
     all_channels_rb = QRadioButton("Multichannel Mode")
@@ -1763,7 +1831,7 @@ def main(preprocess_class = None):
     ALL_CUSTOM_WIDGETS['switch mode buton']=switch_mode_button; 
     ALL_CUSTOM_WIDGETS['show status layer radio']=status_layer_show; ALL_CUSTOM_WIDGETS['hide status layer radio']=status_layer_hide
     ALL_CUSTOM_WIDGETS['show status box radio']=status_box_show; ALL_CUSTOM_WIDGETS['hide status box radio']=status_box_hide
-    ALL_CUSTOM_WIDGETS['page combobox']=page_combobox
+    ALL_CUSTOM_WIDGETS['page combobox']=page_combobox; ALL_CUSTOM_WIDGETS['cache label']=cache_label
     notes_container.setSizePolicy(QSizePolicy.MinimumExpanding,QSizePolicy.MinimumExpanding)
     page_container.setSizePolicy(QSizePolicy.MinimumExpanding,QSizePolicy.MinimumExpanding)
     mode_container.setSizePolicy(QSizePolicy.MinimumExpanding,QSizePolicy.MinimumExpanding)
@@ -1774,6 +1842,8 @@ def main(preprocess_class = None):
 
         
     RAW_PYRAMID=pyramid
+    userInfo.load_decision_sidecar() # decisions saved in sidecar mode that aren't in the .csv yet
+    recovered = userInfo.open_journal() # decisions from a session that crashed before saving
     try:
         tumor_cell_XYs = extract_phenotype_xldata(specific_cell=SPECIFIC_CELL, sort_by_intensity=local_sort)
     except KeyError as e:
@@ -1790,7 +1860,13 @@ def main(preprocess_class = None):
     preprocess_class._append_status_br('Initializing Napari session...')
 
     set_initial_adjustment_parameters(preprocess_class.userInfo.view_settings) # set defaults: 1.0 gamma, 0 black in, 255 white in
+    cache_mb = getattr(userInfo, 'punchout_cache_mb', None) or 1024 # older presets won't have this
+    PUNCHOUT_CACHE = punchout_io.PunchoutCache(cache_mb * 2**20)
     add_layers(viewer,pyramid,tumor_cell_XYs, int(PUNCHOUT_SIZE/2))
+    PREFETCHER = punchout_io.PagePrefetcher(_prefetch_cells)
+    prefetch_neighbouring_pages()
+    SAVER = BackgroundSaver(userInfo)
+    if recovered: viewer.status = f'Recovered {recovered} unsaved decisions from the last session'
     #TODO
     # Perform adjustments before exiting function
     reuse_contrast_limits() # Only checked fluors will be visible
@@ -1813,15 +1889,23 @@ def main(preprocess_class = None):
     sv_wrapper(viewer)
     tsv_wrapper(viewer)
     chn_key_wrapper(viewer)
+    forward_viewer_keys() # the first page's status layer was made before these were bound
     set_viewer_to_neutral_zoom(viewer) # Fix zoomed out issue
 
     if preprocess_class is not None: preprocess_class.close() # close other window
     napari.run()
+    if SAVER is not None: # the final save happens on the way out, after any write in progress
+        SAVER.shutdown()
+        SAVER = None
     # close image file
-
-    if RASTERS is not None:
-        print('Not sure if we have to close this file... the "with" statement should handle it.')
-        RAW_PYRAMID.close()
+    if PREFETCHER is not None:
+        PREFETCHER.shutdown()
+        PREFETCHER = None
+    if SESSION.raster_pool is not None:
+        SESSION.raster_pool.close()
+        SESSION.raster_pool = None
+    if SESSION.journal is not None:
+        SESSION.journal.close() # everything is on disk in the journal. The .csv is written on the way out
 # Main should work now using the defaults specified at the top of this script in the global variable space
 if __name__ == '__main__':
     main()
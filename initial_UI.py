@@ -1,7 +1,7 @@
 #############################################################################
 
 import typing
-from PyQt5.QtCore import QObject, Qt, QThread
+from PyQt5.QtCore import QObject, Qt, QThread, pyqtSignal
 from PyQt5.QtGui import QIcon, QPixmap,QColor,QFont
 from PyQt5.QtWidgets import (QApplication, QCheckBox, QComboBox, QDialog,QMainWindow, QGridLayout, QDesktopWidget, 
                              QGroupBox, QLabel, QLineEdit,QPushButton, QSpinBox, QMenuBar, QAction)
@@ -10,6 +10,7 @@ import sys
 import os
 import time
 import store_and_load
+import object_data
 from galleryViewer import GUI_execute
 import ctypes
 import logging
@@ -303,6 +304,10 @@ class ViewerPresets(QDialog):
     def saveGlobalSort(self):
         print("Saving global sort")
         self.userInfo.global_sort = self.global_sort_widget.currentText()
+    def saveDecisionSidecar(self):
+        self.userInfo.decision_sidecar = self.sidecarCheck.isChecked()
+    def saveVectorStatus(self):
+        self.userInfo.vector_status_layer = self.vectorStatusCheck.isChecked()
 
     def saveChannel(self):
         print(f'\nTrying to save the channel')
@@ -363,6 +368,7 @@ class ViewerPresets(QDialog):
         self.annotationDisplay.setText(current + f'<font color="{status_color}">{anno}<br>')
         self.userInfo.annotation_mappings_label = self.annotationDisplay.text()
         self.userInfo.annotation_mappings[anno] = status
+        self._update_match_count()
     
     def addPheno(self):
         # Get status and color from combobox
@@ -391,6 +397,32 @@ class ViewerPresets(QDialog):
         self.phenoDisplay.setText(current + f'<font color="{status_color}">{pheno}<br>')
         self.userInfo.phenotype_mappings_label = self.phenoDisplay.text()
         self.userInfo.phenotype_mappings[pheno] = status
+        self._update_match_count()
+
+    def _update_match_count(self):
+        ''' Show how many cells the chosen phenotypes / annotations would bring into the gallery'''
+        path = self.dataEntry.text().strip('"')
+        if ".csv" not in path or not os.path.exists(path):
+            self.matchCountLabel.setText('')
+            return None
+        if not (self.userInfo.phenotype_mappings or self.userInfo.annotation_mappings):
+            self.matchCountLabel.setText('')
+            return None
+        if self.match_count_thread is not None and self.match_count_thread.isRunning():
+            self.match_count_pending = True # counted again when the running count finishes
+            return None
+        self.matchCountLabel.setText('Counting cells ...')
+        self.match_count_thread = MatchCountThread(path, list(self.userInfo.phenotype_mappings.keys()),
+                                                   list(self.userInfo.annotation_mappings.keys()))
+        self.match_count_thread.counted.connect(self._show_match_count)
+        self.match_count_thread.start()
+
+    def _show_match_count(self, text):
+        if self.match_count_pending:
+            self.match_count_pending = False
+            self._update_match_count()
+        elif self.userInfo.phenotype_mappings or self.userInfo.annotation_mappings: # not reset in the meantime
+            self.matchCountLabel.setText(text)
 
     def reset_mappings(self):
         self.userInfo.phenotype_mappings = {}
@@ -399,6 +431,7 @@ class ViewerPresets(QDialog):
         self.userInfo.annotation_mappings = {}
         self.userInfo.annotation_mappings_label = '<u>Annotation Layer</u><br>All'
         self.annotationDisplay.setText('<u>Annotation Layer</u><br>All')
+        self.matchCountLabel.setText('')
 
         # Refresh comboboxes
         if self.phenotypeCombo.isVisible() or self.annotationCombo.isVisible():
@@ -444,6 +477,7 @@ class ViewerPresets(QDialog):
         
         try:
             res = self._prefillObjectData()
+            self._update_match_count() # for choices restored from the presets
             annos = self.annotationCombo.count()
             phenos = self.phenotypeCombo.count()
             self.previewObjectDataButton.setEnabled(False)
@@ -483,55 +517,30 @@ class ViewerPresets(QDialog):
         path = self.dataEntry.text().strip('"')
         if ".csv" not in path:
             return None
-        headers = pd.read_csv(path, index_col=False, nrows=0).columns.tolist() 
-        possible_fluors = ['DAPI','Opal 480','Opal 520', 'Opal 570', 'Opal 620','Opal 690', 'Opal 720', 'AF', 'Sample AF', 'Autofluorescence']
-        suffixes = ['Positive Classification', 'Positive Nucleus Classification','Positive Cytoplasm Classification',
-                    'Cell Intensity','Nucleus Intensity', 'Cytoplasm Intensity', '% Nucleus Completeness', '% Cytoplasm Completeness',
-                    '% Cell Completeness', '% Completeness']
-        exclude = ['Cell Area (µm²)', 'Cytoplasm Area (µm²)', 'Nucleus Area (µm²)', 'Nucleus Perimeter (µm)', 'Nucleus Roundness',
-                  'Image Location','Image File Name', 'Analysis Region', 'Algorithm Name', 'Object Id', 'XMin', 'XMax', 'YMin', 'YMax', 'Notes']
-
-        for fl in possible_fluors:
-            for sf in suffixes:
-                exclude.append(f'{fl} {sf}')
-        include = [x for x in headers if ((x not in exclude) and not (any(f in x for f in possible_fluors)))]
+        schema = object_data.read_schema(path) # Reads the cached columns if possible, otherwise parses the file once for later
         
         self.phenotypeToGrab.setVisible(False) #
         self.phenotypeCombo.setVisible(True) 
-        self.phenotypeCombo.addItems(include)
+        self.phenotypeCombo.addItems(schema.phenotype_columns)
         # Assess annotation regions in csv
-        try:
-            regions = list(pd.read_csv(path, index_col=False, usecols=['Analysis Region'])['Analysis Region'].unique()) 
-            print(regions)
-            self.annotationCombo.setVisible(True); self.annotationEdit.setVisible(False)
-            self.annotationCombo.addItems(regions)
-            self.specificCellAnnotationCombo.setVisible(True); self.specificCellAnnotationEdit.setVisible(False)
-            self.specificCellAnnotationCombo.addItems(regions)
-            if self.userInfo.specific_cell is not None:
-                try:
-                    self.specificCellAnnotationCombo.setCurrentText(self.userInfo.specific_cell['Annotation Layer'])
-                except:
-                    pass # If the user misspelled and annotation then just do nothing, it's fine
-        except Exception as e:
+        if not schema.has_regions:
             return 'no annotations'
+        regions = [str(x) for x in schema.regions]
+        print(regions)
+        self.annotationCombo.setVisible(True); self.annotationEdit.setVisible(False)
+        self.annotationCombo.addItems(regions)
+        self.specificCellAnnotationCombo.setVisible(True); self.specificCellAnnotationEdit.setVisible(False)
+        self.specificCellAnnotationCombo.addItems(regions)
+        if self.userInfo.specific_cell is not None:
+            try:
+                self.specificCellAnnotationCombo.setCurrentText(self.userInfo.specific_cell['Annotation Layer'])
+            except:
+                pass # If the user misspelled and annotation then just do nothing, it's fine
         # Check if image location in CSV matches with image given to viewer
-        try:
-            im_location_csv = pd.read_csv(path, index_col=False, nrows=1, usecols=['Image Location']).iloc[0,0]
-            # get everything after the last / , i.e. the image name.
-            # Do it this way since some people use a mapped drive path, some use CIFS, some use UNC path with IP address
-            im_name_csv = sub(r'.*?\\',"", im_location_csv) 
-            path = self.userInfo.qptiff
-            if im_name_csv != sub(r'.*?\\',"", path):
+        if schema.image_name is not None:
+            if schema.image_name != sub(r'.*?\\',"", self.userInfo.qptiff):
                 return 'name conflict'
-        except ValueError: 
-            try: # Attempt to check the alternative column name that might be present
-                im_location_csv = pd.read_csv(path, index_col=False, nrows=1, usecols=['Image File Name']).iloc[0,0]
-                path = self.userInfo.qptiff
-                if im_name_csv != sub(r'.*?\\',"", path):
-                    return 'name conflict'
-            except ValueError:
-                pass 
-            pass # No name columns that I know of, move on.
+        # No name columns that I know of, move on.
         return 'passed'
 
     def prefillImageData(self):
@@ -801,6 +810,12 @@ class ViewerPresets(QDialog):
         self.annotationDisplay.setText(self.userInfo.annotation_mappings_label)
         self.annotationDisplay.setAlignment(Qt.AlignTop)
 
+        # Number of cells the current choices select
+        self.matchCountLabel = QLabel(self.topRightGroupBox)
+        self.matchCountLabel.setAlignment(Qt.AlignTop)
+        self.match_count_thread = None # MatchCountThread loading the data to count cells, off the GUI thread
+        self.match_count_pending = False # The choices changed while a count was running
+
         # Reset button 
         self.resetButton = QPushButton('Reset choices',self.topRightGroupBox)
         self.resetButton.pressed.connect(self.reset_mappings)
@@ -852,6 +867,13 @@ class ViewerPresets(QDialog):
         self.global_sort_widget.setCurrentText(self.userInfo.global_sort)
         self.global_sort_widget.currentTextChanged.connect(self.saveGlobalSort)
 
+        self.sidecarCheck = QCheckBox('Save decisions to a sidecar file (Shift+S writes them to the object data)', self.topRightGroupBox)
+        self.sidecarCheck.setChecked(getattr(self.userInfo, 'decision_sidecar', False)) # older presets won't have this
+        self.sidecarCheck.toggled.connect(self.saveDecisionSidecar)
+
+        self.vectorStatusCheck = QCheckBox('Draw status boxes as shapes', self.topRightGroupBox)
+        self.vectorStatusCheck.setChecked(getattr(self.userInfo, 'vector_status_layer', False)) # older presets won't have this
+        self.vectorStatusCheck.toggled.connect(self.saveVectorStatus)
 
         layout = QGridLayout()
         layout.addWidget(self.phenotypeButton,0,0,Qt.AlignTop)#;layout.addWidget(self.explanationLabel0,0,0)
@@ -872,8 +894,11 @@ class ViewerPresets(QDialog):
         layout.addWidget(self.specificCellAnnotationEdit,5,2,Qt.AlignTop)
         layout.addWidget(self.specificCellAnnotationCombo,5,2,Qt.AlignTop)
         layout.addWidget(self.global_sort_widget,6,0,1,2)
+        layout.addWidget(self.sidecarCheck,7,0,1,3)
+        layout.addWidget(self.vectorStatusCheck,8,0,1,3)
         layout.addWidget(self.phenoDisplay,0,3,7,1)
         layout.addWidget(self.annotationDisplay,0,4,7,1)
+        layout.addWidget(self.matchCountLabel,7,3,1,2)
         # layout.setColumnStretch(3,6)
         # layout.setColumnStretch(4,6)
 
@@ -947,23 +972,22 @@ class ViewerPresets(QDialog):
         return df
 
     '''Find all unique annotation layer names, if the column exists in the data, and return the results'''
-    def _locate_annotations_col(self, path):
-        try:
-            true_annotations = list(pd.read_csv(path, index_col=False, usecols=['Analysis Region'])['Analysis Region'].unique()) 
+    def _locate_annotations_col(self, schema):
+        if schema.has_regions:
+            true_annotations = list(schema.regions)
             self.userInfo.analysisRegionsInData = true_annotations
             return true_annotations
-        except (KeyError, ValueError):
+        else:
             print("No Analysis regions column in data")
             self.userInfo.analysisRegionsInData = False
             return None
 
     '''Check that annotations and phenotypes chosen by the user match the data. Return False if there is a mismatch. 
             Allowed to procees if the annotations column does not exist at all in the data.'''
-    def _validate_names(self):
+    def _validate_names(self, schema):
         # Get headers and unique annotations
-        path = self.userInfo.objectDataPath
-        headers = pd.read_csv(path, index_col=False, nrows=0).columns.tolist() 
-        true_annotations = self._locate_annotations_col(path) # Find out if the data have multiple analysis regions (duplicate Cell IDs as well)
+        headers = schema.headers
+        true_annotations = self._locate_annotations_col(schema) # Find out if the data have multiple analysis regions (duplicate Cell IDs as well)
         if true_annotations is None: 
             self.annotationButton.setEnabled(False)
             self.annotationDisplay.setText('<u>Annotation Layer</u><br>All')
@@ -985,13 +1009,19 @@ class ViewerPresets(QDialog):
     '''Read in the object data file and assign user chosen validation calls to the data, if needed'''
     def assign_statuses_to_sheet(self):
         self._replace_status('Reading object data... ')
-        df = pd.read_csv(self.userInfo.objectDataPath)
+        if self.match_count_thread is not None: self.match_count_thread.wait() # it may be reading the same file
+        # Only the columns the viewer uses are read. No re-read if they were already fetched
+        data = object_data.ingest(self.userInfo.objectDataPath, extra_columns = list(self.userInfo.phenotype_mappings.keys()))
+        df = data.df
+        self.userInfo.objectDataSchema = data.schema
+        self.userInfo.objectDataBitmaps = data.bitmaps
         self._append_status('<font color="#7dbc39">  Done. </font>')
         self._append_status_br('Validating chosen annotations and phenotypes...')
-        if self._validate_names():
+        if self._validate_names(data.schema):
             self._append_status('<font color="#7dbc39">  Done. </font>')
             df = self.assign_phenotype_statuses_to_sheet(df)
             df = self.assign_annotation_statuses_to_sheet(df)
+            df = object_data.compact(df, data.schema) # validation columns may have just been added
             try:
                 # self._append_status_br('Saving data back to file...')
                 # df.to_csv(self.userInfo.objectDataPath,index=False)
@@ -1071,6 +1101,27 @@ class ViewerPresets(QDialog):
             logpath = os.path.normpath(os.path.join(folder, datetime.today().strftime('%Y-%m-%d_runtime_crash_%H%M%S.txt')))
             self._log_problem(logpath,e)
         
+class MatchCountThread(QThread):
+    ''' Loads the object data (the table is kept for when the gallery opens) and counts the cells that the
+        chosen phenotypes / annotations select, without freezing the dialog'''
+    counted = pyqtSignal(str)
+    def __init__(self, path, phenotypes, regions) -> None:
+        super().__init__()
+        self.path = path
+        self.phenotypes = phenotypes
+        self.regions = regions
+    def run(self):
+        try:
+            bitmaps = object_data.ingest(self.path).bitmaps
+            selected = bitmaps.any_of(phenotypes = self.phenotypes, regions = self.regions)
+            text = f'{bitmaps.count(selected):,} of {bitmaps.n_rows:,} cells selected'
+        except KeyError as e:
+            text = f'<font color="#ffa000">{e} is not a column in the data</font>'
+        except (OSError, ValueError) as e:
+            print(f'Could not count matching cells: {e}')
+            text = ''
+        self.counted.emit(text)
+
 class ThreadSave(QThread):
     def __init__(self, gallery:ViewerPresets, target=None) -> None:
         super().__init__()
@@ -0,0 +1,371 @@
+'''
+Project - CTC Gallery viewer with Napari
+
+Description - reading the Halo object data
+    The object data .csv is parsed once per session. Everything else that needs to know about the
+    file (headers, intensity and phenotype columns, annotation regions, image name) asks the schema
+    that is built during that one pass, instead of reading the file again.
+    The first time a .csv is read, a columnar copy (Parquet) is written next to it. Later launches load
+    from that copy, which is much faster and can be limited to the columns that are needed. The copy is
+    tied to the size, modification time and header of the .csv and is rebuilt whenever those change.
+
+Peter Richieri
+Ting Lab
+2023
+'''
+
+import os
+import json
+import hashlib
+from re import sub
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+import csv_io
+
+POSSIBLE_FLUORS = ['DAPI','Opal 480','Opal 520', 'Opal 570', 'Opal 620','Opal 690', 'Opal 720', 'AF', 'Sample AF', 'Autofluorescence']
+INTENSITY_SUFFIXES = ['Cell Intensity','Nucleus Intensity', 'Cytoplasm Intensity']
+# Per-fluor columns that are never phenotypes
+FLUOR_SUFFIXES = ['Positive Classification', 'Positive Nucleus Classification','Positive Cytoplasm Classification',
+                  'Cell Intensity','Nucleus Intensity', 'Cytoplasm Intensity', '% Nucleus Completeness', '% Cytoplasm Completeness',
+                  '% Cell Completeness', '% Completeness']
+NON_PHENOTYPE_COLUMNS = ['Cell Area (µm²)', 'Cytoplasm Area (µm²)', 'Nucleus Area (µm²)', 'Nucleus Perimeter (µm)', 'Nucleus Roundness',
+                         'Image Location','Image File Name', 'Analysis Region', 'Algorithm Name', 'Object Id', 'XMin', 'XMax', 'YMin', 'YMax', 'Notes']
+
+CATEGORY_COLUMNS = ['Analysis Region', 'Image Location', 'Image File Name', 'Algorithm Name'] # Strings repeated on every row
+COORDINATE_COLUMNS = ['XMin', 'XMax', 'YMin', 'YMax']
+
+INTENSITY_COMPARTMENTS = ['Cytoplasm Intensity', 'Nucleus Intensity', 'Cell Intensity'] # Order of the values in an IntensityMap
+AF_NAMES = ['AF', 'Autofluorescence', 'Sample AF'] # Different exports name the autofluorescence channel differently
+
+class IntensityMap:
+    ''' Which intensity columns belong to each viewer channel, worked out once. For every channel there is
+    a cytoplasm, nucleus and cell column (or None), and the name to show for it. gather() pulls a page's
+    intensities out into a single float32 array of shape (cells, channels, 3).'''
+    def __init__(self, intensity_columns, channels) -> None:
+        self.channels = list(channels) # Viewer channel names, e.g. 'DAPI', 'OPAL520', 'AF', in position order
+        self.columns = [] # For each channel, [cyto column, nucleus column, cell column] with None for missing ones
+        self.display_names = [] # For each channel, the fluor name as it appears in the data
+        names = sorted(intensity_columns)
+        for channel in self.channels:
+            lookups = [channel.replace("OPAL","Opal ")]
+            if channel in AF_NAMES: # Try the other autofluorescence names if this one has no columns
+                lookups += list(reversed([x for x in AF_NAMES if x != channel]))
+            columns = [None, None, None]; display = lookups[0]
+            for lookup in lookups:
+                found = [[x for x in names if (lookup in x and suffix in x)] for suffix in INTENSITY_COMPARTMENTS]
+                if any(found):
+                    columns = [f[0] if f else None for f in found]
+                    last = [(c, suffix) for c, suffix in zip(columns, INTENSITY_COMPARTMENTS) if c is not None][-1]
+                    display = last[0].replace(' ' + last[1], '')
+                    break
+            self.columns.append(columns)
+            self.display_names.append(display)
+
+    def gather(self, df):
+        ''' Return a float32 array (rows of df, channels, 3) of cyto, nucleus and cell intensity. NaN where there's no column.'''
+        values = np.full((len(df.index), len(self.channels), len(INTENSITY_COMPARTMENTS)), np.nan, dtype=np.float32)
+        for i, columns in enumerate(self.columns):
+            for j, col in enumerate(columns):
+                if col is not None and col in df.columns:
+                    values[:, i, j] = df[col].to_numpy(dtype=np.float32)
+        return values
+
+class ObjectDataSchema:
+    ''' Summary of an object data file, built once at ingest and shared by everything that needs it'''
+    def __init__(self, headers, regions = None, image_location = None) -> None:
+        self.headers = list(headers) # String list - all column names, in file order
+        self.regions = regions # String list of unique 'Analysis Region' values, or None if the column is missing
+        self.image_location = image_location # String - path of the image used to generate the data, or None
+        # Everything after the last \, i.e. the image name. Some people use a mapped drive path, some use CIFS, some use UNC path with IP address
+        self.image_name = sub(r'.*?\\',"", image_location) if image_location is not None else None
+        self.intensity_columns = [x for x in self.headers if (any(s in x for s in INTENSITY_SUFFIXES) and (any(f in x for f in POSSIBLE_FLUORS)))]
+        exclude = NON_PHENOTYPE_COLUMNS + [f'{fl} {sf}' for fl in POSSIBLE_FLUORS for sf in FLUOR_SUFFIXES]
+        self.phenotype_columns = [x for x in self.headers if ((x not in exclude) and not (any(f in x for f in POSSIBLE_FLUORS)))]
+
+    @property
+    def has_regions(self):
+        return self.regions is not None
+
+    def intensity_map(self, channels):
+        ''' Resolve the intensity columns for the given viewer channels. See IntensityMap.'''
+        return IntensityMap(self.intensity_columns, channels)
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8) # set bits in each byte value
+
+class MembershipBitmaps:
+    ''' Packed bitmaps (one bit per table row) of which cells are positive for each phenotype and which
+    are in each Analysis Region. Filters are combined with bitwise operations on these instead of
+    querying the table.'''
+    def __init__(self, n_rows, phenotypes, regions) -> None:
+        self.n_rows = n_rows # Int - number of rows in the table the bitmaps were built from
+        self.phenotypes = phenotypes # Dict of phenotype column name -> packed uint8 bitmap
+        self.regions = regions # Dict of Analysis Region name -> packed uint8 bitmap
+
+    @classmethod
+    def from_table(cls, df, schema):
+        phenotypes = {col: np.packbits((df[col] == 1).to_numpy()) for col in schema.phenotype_columns if col in df.columns}
+        regions = {}
+        if 'Analysis Region' in df.columns:
+            layers = pd.Categorical(df['Analysis Region'])
+            codes = layers.codes
+            for code, name in enumerate(layers.categories):
+                regions[str(name)] = np.packbits(codes == code)
+        return cls(len(df.index), phenotypes, regions)
+
+    def _selected(self, phenotypes, regions):
+        ''' Bitmaps for the given names. Phenotypes must be in the data, an unknown region just has no cells.'''
+        empty = np.zeros((self.n_rows + 7)//8, dtype=np.uint8)
+        return [self.phenotypes[p] for p in phenotypes] + [self.regions.get(str(r), empty) for r in regions]
+
+    def everything(self):
+        return np.packbits(np.ones(self.n_rows, dtype=bool))
+
+    def any_of(self, phenotypes = (), regions = ()):
+        ''' Cells positive for any phenotype or in any region given. All cells if nothing is given,
+            the same rule the viewer uses to pick cells to review.'''
+        selected = self._selected(phenotypes, regions)
+        if not selected: return self.everything()
+        return np.bitwise_or.reduce(selected)
+
+    def all_of(self, phenotypes = (), regions = ()):
+        ''' Cells positive for every phenotype and in every region given'''
+        selected = self._selected(phenotypes, regions)
+        if not selected: return self.everything()
+        return np.bitwise_and.reduce(selected)
+
+    def count(self, bitmap):
+        return int(_POPCOUNT[bitmap].sum(dtype=np.int64))
+
+    def mask(self, bitmap):
+        ''' Unpack a bitmap to a boolean array with one entry per table row'''
+        return np.unpackbits(bitmap, count=self.n_rows).astype(bool)
+
+class ObjectData:
+    ''' The result of ingesting an object data file: the table itself, its schema, and membership bitmaps'''
+    def __init__(self, path, df, schema, signature) -> None:
+        self.path = path
+        self.df = df
+        self.schema = schema
+        self.bitmaps = MembershipBitmaps.from_table(df, schema)
+        self.signature = signature # (path, size, mtime) of the file when it was read
+
+_LAST_INGEST = None # Only the most recent file is kept, so an abandoned path doesn't hold its table in memory
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+CACHE_VERSION = 2
+
+def cache_paths(path):
+    ''' Return (data path, metadata path) of the columnar cache for an object data .csv'''
+    root, _ = os.path.splitext(path)
+    return root + '.objcache.parquet', root + '.objcache.json'
+
+def _header_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.readline()).hexdigest()
+
+def _cache_key(path):
+    ''' What the cache must have been built from to be usable'''
+    stat = os.stat(path)
+    return {'version': CACHE_VERSION, 'path': os.path.abspath(path), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns, 'header': _header_hash(path)}
+
+def _valid_cache(path, columns = None):
+    ''' Return the cache data path if there is an up to date cache for this .csv that holds all of
+        the given columns, otherwise None'''
+    data_path, meta_path = cache_paths(path)
+    if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+        return None
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        cached_columns = meta.pop('columns', [])
+        if meta != _cache_key(path):
+            return None
+        if columns is not None and not set(columns).issubset(cached_columns):
+            return None
+    except (OSError, ValueError):
+        return None
+    return data_path
+
+def write_cache(path, df):
+    ''' Write a columnar copy of the table next to the .csv it came from. The table's rows must match
+        what is on disk at 'path', but it can hold just some of the columns.
+        Does nothing (besides printing) if Parquet support isn't installed.'''
+    data_path, meta_path = cache_paths(path)
+    try:
+        df.to_parquet(data_path + '.tmp', index=False)
+        os.replace(data_path + '.tmp', data_path)
+        meta = _cache_key(path); meta['columns'] = [str(c) for c in df.columns]
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    except ImportError:
+        print('Parquet support (pyarrow) is not installed, the object data will be read from the .csv every time')
+    except Exception as e:
+        print(f'Could not write the object data cache at {data_path}: {e}')
+        for leftover in (data_path + '.tmp', meta_path):
+            if os.path.exists(leftover): os.remove(leftover)
+
+def _read_cache(data_path, columns = None):
+    try:
+        return pd.read_parquet(data_path, columns=columns, memory_map=True)
+    except Exception as e:
+        print(f'Could not read the object data cache at {data_path}, falling back to the .csv: {e}')
+        return None
+
+def read_headers(path):
+    return csv_io.read_header(path)
+
+def session_columns(headers):
+    ''' The columns the viewer works with: ids, region, bounding box, phenotype flags, intensities,
+        validation calls and notes (plus the image name, for checking the image). Everything else
+        (completeness, areas, classifications...) stays on disk and is carried through on save.'''
+    schema = ObjectDataSchema(headers)
+    wanted = set(["Object Id", "Analysis Region", "Image Location", "Image File Name", "XMin", "XMax", "YMin", "YMax", "Notes"]
+                 + schema.phenotype_columns + schema.intensity_columns)
+    return [c for c in headers if c in wanted or c.startswith('Validation | ')]
+
+def _concat_chunks(chunks):
+    ''' Join chunks read with read_csv, keeping categorical columns categorical'''
+    if not chunks: return None
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            categories = union_categoricals([chunk[col] for chunk in chunks], sort_categories=True).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+def _read_csv_projected(path, columns, schema):
+    ''' Read only the given columns, a chunk at a time. Each chunk is downcast before the next is read,
+        so the peak is about one chunk at full width on top of the compact table.'''
+    df = _concat_chunks(csv_io.read_chunks(path, columns, convert = lambda chunk: compact(chunk, schema)))
+    if df is None: df = pd.DataFrame(columns=columns) # empty file
+    return df[[c for c in columns if c in df.columns]] # usecols doesn't keep the order given
+
+def ingest(path, extra_columns = ()):
+    ''' Read the columns the viewer needs from an object data .csv and build its schema. extra_columns
+        are loaded as well, for phenotypes that don't look like one by name. Repeated calls for a file
+        that hasn't changed on disk return the same result without reading it again.'''
+    global _LAST_INGEST
+    signature = _file_signature(path)
+    if (_LAST_INGEST is not None and _LAST_INGEST.signature == signature
+            and set(extra_columns).issubset(_LAST_INGEST.df.columns)):
+        return _LAST_INGEST
+
+    headers = read_headers(path)
+    schema = ObjectDataSchema(headers)
+    columns = session_columns(headers)
+    columns += [c for c in headers if c in extra_columns and c not in columns]
+    df = None
+    cached = _valid_cache(path, columns)
+    if cached is not None:
+        df = _read_cache(cached, columns)
+    if df is None:
+        df = _read_csv_projected(path, columns, schema)
+        write_cache(path, df)
+    else:
+        compact(df, schema)
+    schema = build_schema(df, headers = headers)
+    _LAST_INGEST = ObjectData(path, df, schema, signature)
+    return _LAST_INGEST
+
+def read_schema(path):
+    ''' Build the schema without loading the whole table, when the columnar cache is up to date.
+        Otherwise this ingests the file (and builds the cache), so the table is ready for later.'''
+    if _LAST_INGEST is not None and _LAST_INGEST.signature == _file_signature(path):
+        return _LAST_INGEST.schema
+    headers = read_headers(path)
+    needed = [c for c in ['Analysis Region', 'Image Location', 'Image File Name'] if c in headers]
+    cached = _valid_cache(path, needed)
+    if cached is not None:
+        df = _read_cache(cached, columns=needed)
+        if df is not None:
+            return build_schema(df, headers = headers)
+    return ingest(path).schema
+
+def write_back(path, df, owned_columns, progress = None):
+    ''' Save the session's columns into the .csv at 'path' without loading the rest of it. The file is
+        streamed in chunks. Columns the session doesn't own are copied through as the exact text they
+        had. Owned columns (validation calls, notes) are taken from 'df', whose rows must line up with
+        the file's, and must not change while this runs (see snapshot). Owned columns the file doesn't have yet go in at position 8, like
+        userPresets._save_validation has always put them. A PermissionError means the file is open
+        somewhere else. progress, if given, is called with the number of rows written after each chunk.'''
+    headers = read_headers(path)
+    out_headers = list(headers)
+    for col in reversed(owned_columns):
+        if col not in out_headers: out_headers.insert(8, col)
+    owned = {}
+    for col in owned_columns:
+        values = df[col]
+        if values.dtype == np.float32: # compact() narrowed it, writing it would change the numbers in the file
+            raise ValueError(f"'{col}' was downcast to float32 when it was read and can't be written back without losing precision")
+        if values.dtype == object: values = values.fillna('').astype(str) # text columns are written as text, blanks as ''
+        owned[col] = values.to_numpy()
+    tmp_path = path + '.saving'
+    written = 0
+    try:
+        with csv_io.CsvWriter(tmp_path, engine='pandas') as writer: # Arrow would quote every text value
+            for chunk in csv_io.iter_chunks(path, as_text=True):
+                stop = written + len(chunk.index)
+                if stop > len(df.index):
+                    raise ValueError(f'{path} has more rows than the data in memory. Was it changed while the viewer was open?')
+                for col in owned_columns:
+                    chunk[col] = owned[col][written:stop]
+                writer.write(chunk[out_headers])
+                written = stop
+                if progress is not None: progress(written)
+            if written == 0: writer.write(pd.DataFrame(columns=out_headers)) # keep the header of an empty table
+        if written != len(df.index):
+            raise ValueError(f'{path} has fewer rows than the data in memory. Was it changed while the viewer was open?')
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def snapshot(df, columns):
+    ''' Return a copy of the table that another thread can write out while this one keeps changing it.
+        The given columns (the ones the session writes into) are copied, the rest are shared with
+        'df' since they don't change after the data is loaded.'''
+    snap = df.copy(deep=False)
+    for col in columns:
+        if col in df.columns: snap[col] = df[col].copy()
+    return snap
+
+def _downcast_int(df, col, dtype):
+    series = df[col]
+    if not pd.api.types.is_integer_dtype(series.dtype) or series.dtype == dtype:
+        return None # Has missing values (so it's float) or is already small
+    info = np.iinfo(dtype)
+    if len(series.index) and (series.min() < info.min or series.max() > info.max):
+        return None # Not a flag after all
+    df[col] = series.astype(dtype)
+
+def compact(df, schema):
+    ''' Downcast the table's columns in place, using the schema to tell what each column holds.
+        Region / path strings become categoricals, phenotype and validation flags int8, intensities
+        float32 and coordinates int32. Values are unchanged, so the .csv written back looks the same.'''
+    for col in df.columns:
+        if col in CATEGORY_COLUMNS:
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype('category')
+        elif col in COORDINATE_COLUMNS:
+            _downcast_int(df, col, np.int32)
+        elif col in schema.intensity_columns:
+            if df[col].dtype == np.float64:
+                df[col] = df[col].astype(np.float32)
+        elif col.startswith('Validation | ') or col in schema.phenotype_columns:
+            _downcast_int(df, col, np.int8)
+    return df
+
+def build_schema(df, headers = None):
+    ''' Build an ObjectDataSchema from a loaded table. Pass the full header list if only some columns were loaded'''
+    regions = list(df['Analysis Region'].unique()) if 'Analysis Region' in df.columns else None
+    image_location = None
+    for col in ['Image Location', 'Image File Name']: # Check the alternative column name that might be present
+        if col in df.columns and len(df.index) > 0:
+            image_location = str(df[col].iloc[0])
+            break
+    if headers is None: headers = df.columns.tolist()
+    return ObjectDataSchema(headers, regions = regions, image_location = image_location)
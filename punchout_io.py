@@ -0,0 +1,299 @@
+'''
+Project - CTC Gallery viewer with Napari
+
+Description - helpers for reading cell punchouts from the image
+    Holds the raster handles that stay open for the length of a session, so that pages of cells
+    can be read without reopening the QPTIFF for every cell and channel, reads the punchouts
+    for a whole page on a pool of worker threads. Punchouts are kept in a memory-bounded cache, and
+    neighbouring pages are prefetched into it in the background. A prebuilt 'gallery pack' (see
+    build_gallery_pack.py) can be used instead of the image for any cell it contains.
+
+Peter Richieri
+Ting Lab
+2023
+'''
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1) # GDAL and tifffile release the GIL while decoding, so threads scale well
+_EXECUTOR = None # Shared reader threads. They live for the whole session so that their raster handles do too
+_EXECUTOR_WORKERS = 0
+_EXECUTOR_LOCK = threading.Lock()
+
+def _shared_executor(workers):
+    global _EXECUTOR, _EXECUTOR_WORKERS
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None or _EXECUTOR_WORKERS != workers:
+            if _EXECUTOR is not None: _EXECUTOR.shutdown(wait=False)
+            _EXECUTOR = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='punchout')
+            _EXECUTOR_WORKERS = workers
+        return _EXECUTOR
+
+class RasterPool:
+    ''' Opens each rasterio subdataset (one per channel of a QPTIFF) the first time it is needed and
+    keeps it open until close() is called. Should be created once per session and closed at shutdown.
+    GDAL handles can't be shared between threads, so each thread that reads gets its own set.'''
+    def __init__(self, subdatasets) -> None:
+        self.subdatasets = list(subdatasets) # List of GDAL subdataset strings, in image channel order
+        self._local = threading.local() # Per-thread dict of channel position -> open rasterio dataset
+        self._all_handles = [] # Every dataset opened by any thread, so they can all be closed later
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.subdatasets)
+
+    def get(self, pos):
+        ''' Return the calling thread's open dataset for the channel at position 'pos', opening it if needed'''
+        handles = getattr(self._local, 'handles', None)
+        if handles is None:
+            handles = self._local.handles = {}
+        try:
+            return handles[pos]
+        except KeyError:
+            handle = rasterio.open(self.subdatasets[pos])
+            handles[pos] = handle
+            with self._lock:
+                self._all_handles.append(handle)
+            return handle
+
+    def close(self):
+        ''' Close every dataset that was opened. Safe to call more than once.'''
+        with self._lock:
+            for handle in self._all_handles:
+                try:
+                    handle.close()
+                except Exception:
+                    pass # Already closed or never fully opened, nothing else to do
+            self._all_handles = []
+        self._local = threading.local()
+
+def filter_subdatasets(raw_subdata):
+    ''' Remove overview pic and label pic from a QPTIFF's subdatasets, leaving one per channel in order.
+        They happen to be in the middle of the set, and aren't really well labelled.'''
+    to_remove = []
+    for sds in raw_subdata:
+        # These are the IDS of the crap data.
+        if sds.replace('GTIFF_DIR:','')[1].isdigit() or sds.replace('GTIFF_DIR:','').startswith('9'):
+            to_remove.append(sds)
+    return [sds for sds in raw_subdata if sds not in to_remove]
+
+def read_punchout(center_x, center_y, offset, pos, pool = None, pyramid = None):
+    ''' Read a single channel window of size (offset*2, offset*2) around a cell center.
+        Uses the rasterio pool if given, otherwise slices the in-memory / memory-mapped [X,Y,C] array.'''
+    if pool is not None:
+        channel = pool.get(pos)
+        return channel.read(1,window=Window(center_x-offset,center_y-offset, offset*2,offset*2))
+    return pyramid[center_x-offset:center_x+offset,center_y-offset:center_y+offset,pos]
+
+def extract_page_punchouts(centers, positions, offset, pool = None, pyramid = None, workers = None, cancelled = None):
+    ''' Read every (cell, channel) window for a page at once.
+        centers - list of (x,y) cell centers
+        positions - list of channel positions in the image to read
+        cancelled - optional callable. Once it returns True the remaining reads are skipped, so a
+                    background read that is no longer wanted gives the shared threads back quickly
+        Returns a uint8 array of shape (cells, channels, offset*2, offset*2). Windows that run off the edge
+        of the image are left black past the edge.'''
+    size = offset*2
+    punchouts = np.zeros((len(centers), len(positions), size, size), dtype=np.uint8)
+    if not centers or not positions:
+        return punchouts
+
+    def _read(job):
+        if cancelled is not None and cancelled(): return None # left black, the caller throws the result away
+        i, j = job
+        x, y = centers[i]
+        data = read_punchout(x, y, offset, positions[j], pool=pool, pyramid=pyramid)
+        h = min(size, data.shape[0]); w = min(size, data.shape[1])
+        punchouts[i,j,:h,:w] = data[:h,:w] # each job writes its own slot, no lock needed
+
+    jobs = [(i,j) for i in range(len(centers)) for j in range(len(positions))]
+    if workers is None: workers = DEFAULT_WORKERS
+    if workers <= 1:
+        for job in jobs: _read(job)
+    else:
+        list(_shared_executor(workers).map(_read, jobs)) # list() re-raises any read error here
+    return punchouts
+
+class PunchoutCache:
+    ''' In-memory LRU store of single channel punchouts with a memory budget. Keys are tuples of
+    (Analysis Region, Object Id, channel position, punchout size, pyramid level). Keeps hit, miss
+    and eviction counts so they can be shown to the user.'''
+    def __init__(self, budget_bytes) -> None:
+        self.budget_bytes = int(budget_bytes) # Int - max number of bytes of pixel data to hold
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._store = OrderedDict() # key -> 2D uint8 array, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, key, record = True):
+        ''' Return the cached punchout for a key, or None. Set record to False for lookups that
+            shouldn't count towards the hit / miss numbers (e.g. background prefetching)'''
+        with self._lock:
+            punchout = self._store.get(key)
+            if punchout is None:
+                if record: self.misses += 1
+                return None
+            self._store.move_to_end(key)
+            if record: self.hits += 1
+            return punchout
+
+    def put(self, key, punchout):
+        ''' Add a punchout, evicting the least recently used ones until the cache is under budget'''
+        if punchout.nbytes > self.budget_bytes:
+            return None # would never fit
+        punchout = np.ascontiguousarray(punchout) # don't keep a view holding a whole page alive
+        if punchout.base is not None: punchout = punchout.copy()
+        with self._lock:
+            old = self._store.pop(key, None)
+            if old is not None: self.bytes_used -= old.nbytes
+            self._store[key] = punchout
+            self.bytes_used += punchout.nbytes
+            while self.bytes_used > self.budget_bytes:
+                _, evicted = self._store.popitem(last=False)
+                self.bytes_used -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._store = OrderedDict()
+            self.bytes_used = 0
+
+    def summary(self):
+        ''' Short description of the cache state for the viewer status bar'''
+        return (f'Image cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions '
+                f'({self.bytes_used/2**20:.0f} of {self.budget_bytes/2**20:.0f} MB)')
+
+class PagePrefetcher:
+    ''' Reads the punchouts of nearby pages on a background thread so that flipping to those pages
+    doesn't touch the disk. The reading function is expected to store what it reads in a PunchoutCache.
+    Call retarget() whenever the current page, sort or filter changes.'''
+    def __init__(self, read_cells) -> None:
+        self.read_cells = read_cells # Callable taking a list of [region, id, x, y] cells and a cancelled() check. Should skip cells that are already cached
+        self._futures = []
+        self._generation = 0 # Bumped on every retarget so stale work is skipped
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+
+    def retarget(self, pages):
+        ''' pages - list of lists of [region, id, x, y] cells, most important first. Cancels any
+            work that is still pending and starts reading the given pages.'''
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            for future in self._futures: future.cancel()
+            self._futures = [self._executor.submit(self._fill, generation, cells) for cells in pages if cells]
+
+    def cancel(self):
+        ''' Stop any pending reads. A page that is already being read stops at its next channel read'''
+        with self._lock:
+            self._generation += 1
+            for future in self._futures: future.cancel()
+            self._futures = []
+
+    def _fill(self, generation, cells):
+        stale = lambda: generation != self._generation
+        if stale(): return None
+        try:
+            self.read_cells(cells, stale)
+        except Exception as e:
+            print(f'Prefetch failed, pages will be read when they are opened: {e}')
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=True)
+
+PACK_VERSION = 2
+PLACEMENT_COLUMNS = ['Analysis Region', 'Object Id', 'XMin', 'XMax', 'YMin', 'YMax'] # Where each cell is, see placement_hash
+
+def gallery_pack_paths(object_data_path, punchout_size):
+    ''' Return (data path, index path) of the gallery pack for an object data file and punchout size'''
+    root, _ = os.path.splitext(object_data_path)
+    return f'{root}_{punchout_size}px.gpack.npy', f'{root}_{punchout_size}px.gpack.index.npz'
+
+def placement_hash(object_table):
+    ''' Hash of the region, id and bounding box of every row of the object data, in file order. A pack is only
+        used with the object data it was built from. Validation calls and notes change with every save, so
+        they aren't included.'''
+    h = hashlib.sha1()
+    for col in PLACEMENT_COLUMNS:
+        if col not in object_table.columns: continue
+        h.update(col.encode('utf-8'))
+        if col == 'Analysis Region':
+            h.update('\n'.join(object_table[col].astype(str).tolist()).encode('utf-8'))
+        else:
+            h.update(np.ascontiguousarray(object_table[col].to_numpy(dtype=np.int64)).tobytes())
+    return h.hexdigest()
+
+def _pack_keys(region_codes, object_ids):
+    return region_codes.astype(np.int64) * 2**32 + object_ids.astype(np.int64)
+
+class GalleryPack:
+    ''' Read-only view of a gallery pack: every cell's multichannel punchout, precomputed and stored
+    in one memory-mapped array of shape (cells, image channels, H, W), plus a sidecar index that maps
+    (Analysis Region, Object Id) to a slot. Serving a page from the pack is just slicing the memmap.'''
+    def __init__(self, data_path, index_path) -> None:
+        with np.load(index_path, allow_pickle=False) as index:
+            self.meta = json.loads(str(index['meta']))
+            self.region_names = [str(x) for x in index['region_names']]
+            self.rows = index['rows'] # table row of each slot
+            keys = _pack_keys(index['region_codes'], index['object_ids'])
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._order]
+        self._region_lookup = {name: code for code, name in enumerate(self.region_names)}
+        self.data = np.load(data_path, mmap_mode='r')
+
+    def slot(self, region, object_id):
+        ''' Return the slot holding a cell, or None if the cell isn't in the pack'''
+        code = self._region_lookup.get(str(region))
+        if code is None: return None
+        key = np.int64(code) * 2**32 + np.int64(object_id)
+        i = np.searchsorted(self._sorted_keys, key)
+        if i < len(self._sorted_keys) and self._sorted_keys[i] == key:
+            return int(self._order[i])
+        return None
+
+    @classmethod
+    def find(cls, object_data_path, image_path, punchout_size, pyramid_level = 0, object_table = None):
+        ''' Load the pack for this object data and punchout size if one exists and was built from the same
+            image at the same pyramid level, and (given the object data table) from the same cells.
+            Returns None otherwise.'''
+        data_path, index_path = gallery_pack_paths(object_data_path, punchout_size)
+        if not (os.path.exists(data_path) and os.path.exists(index_path)):
+            return None
+        try:
+            pack = cls(data_path, index_path)
+            meta = pack.meta
+            if (meta.get('version') != PACK_VERSION or meta.get('punchout_size') != punchout_size
+                    or meta.get('pyramid_level') != pyramid_level
+                    or meta.get('image_name') != os.path.basename(image_path)
+                    or meta.get('image_bytes') != os.path.getsize(image_path)):
+                print(f'Gallery pack at {data_path} was built for different settings, ignoring it.')
+                return None
+            if object_table is not None and meta.get('placement_hash') != placement_hash(object_table):
+                print(f'Gallery pack at {data_path} was built from different object data, ignoring it. Rebuild it with build_gallery_pack.py')
+                return None
+            return pack
+        except Exception as e:
+            print(f'Could not open gallery pack at {data_path}: {e}')
+            return None
+
+def write_gallery_pack_index(index_path, meta, region_names, region_codes, object_ids, rows):
+    ''' Write the sidecar index for a gallery pack'''
+    meta = dict(meta); meta['version'] = PACK_VERSION
+    with open(index_path, 'wb') as f: # np.savez would add '.npz' to a path given as a string
+        np.savez(f, meta=np.array(json.dumps(meta)), region_names=np.array(region_names, dtype=str),
+                 region_codes=np.asarray(region_codes, dtype=np.int32), object_ids=np.asarray(object_ids, dtype=np.int64),
+                 rows=np.asarray(rows, dtype=np.int64))
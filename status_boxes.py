@@ -0,0 +1,53 @@
+'''
+Project - CTC Gallery viewer with Napari
+
+Description - the coloured boxes drawn around each cell on the status layer
+    The shape of a box only depends on the punchout size, the viewing mode and whether labels are drawn
+    in a box, so it is worked out once per combination (a template) and kept. Painting a box copies the
+    cell's cached label strip into the overlay and colours the template's border pixels, in place.
+    Changing a status repaints just those pixels of one box.
+
+Peter Richieri
+Ting Lab
+2023
+'''
+
+import numpy as np
+import cell_labels
+
+CORNER_BOX_SIZE = 16 # Height of the label strip, and size of the solid box in its left corner
+EDGE_WIDTH = 1
+
+_TEMPLATES = {}
+
+class BoxTemplate:
+    ''' Geometry of one status box. border holds the (row, column) indices of every border pixel.'''
+    def __init__(self, punchout_size, width, absorption, label_only) -> None:
+        self.height = punchout_size + 2*EDGE_WIDTH
+        self.width = width
+        self.absorption = absorption
+        self.background = (255,255,255,0) if absorption else (0,0,0,0) # transparent
+        self.label_height = self.height if label_only else CORNER_BOX_SIZE
+        border = np.zeros((self.height, width), dtype=bool)
+        if not label_only:
+            border[:CORNER_BOX_SIZE, :CORNER_BOX_SIZE] = True
+            border[:EDGE_WIDTH, :] = True; border[-EDGE_WIDTH:, :] = True
+            border[:, :EDGE_WIDTH] = True; border[:, -EDGE_WIDTH:] = True
+        self.border = np.nonzero(border)
+
+def template(punchout_size, width, absorption, label_only):
+    key = (punchout_size, width, absorption, label_only)
+    if key not in _TEMPLATES:
+        _TEMPLATES[key] = BoxTemplate(punchout_size, width, absorption, label_only)
+    return _TEMPLATES[key]
+
+def paint(buffer, top, left, box_template, color, cell_name, fill = True):
+    ''' Draw a status box with its top left corner at (top, left) of an RGBA buffer. fill clears the inside
+        of the box as well, which is only needed the first time a box is drawn on a fresh buffer.
+        Returns the (top, left, height, width) region of the buffer that was drawn on.'''
+    box = buffer[top:top+box_template.height, left:left+box_template.width]
+    if fill: box[...] = box_template.background
+    box[:box_template.label_height] = cell_labels.render_label(cell_name, box_template.label_height, box_template.width,
+                                                                color, box_template.absorption)
+    box[box_template.border] = color
+    return top, left, box.shape[0], box.shape[1]
@@ -0,0 +1,73 @@
+'''
+Project - CTC Gallery viewer with Napari
+
+Description - status overlay drawn as vector shapes
+    An alternative to the rasterized RGBA status layer. Each cell on the page gets one rectangle and one
+    text label on a napari Shapes layer, coloured by a 'status' feature. Changing a status updates that
+    feature and the rectangle's edge colour, nothing is re-rasterized, and the layer takes almost no memory.
+
+Peter Richieri
+Ting Lab
+2023
+'''
+
+import numpy as np
+import pandas as pd
+import cell_labels
+
+LABEL_SIZE = 8 # Points
+EDGE_WIDTH = 1 # Data pixels, same as the raster boxes
+
+class VectorStatusOverlay:
+    ''' Wraps the Shapes layer for one page. boxes are (top, left, height, width) in data pixels, one per
+        cell name. statuses_rgba maps each status to an RGBA tuple (0-255).'''
+    def __init__(self, viewer, boxes, cell_names, statuses, statuses_rgba, label_only = False, scale = None) -> None:
+        self.statuses_rgba = statuses_rgba
+        self.index = {name: i for i, name in enumerate(cell_names)}
+        self.boxes_visible = not label_only
+        self.label_only = label_only
+        rectangles = [np.array([[top, left], [top+height-1, left+width-1]]) for top, left, height, width in boxes]
+        features = pd.DataFrame({'label': [cell_labels.display_text(name) for name in cell_names],
+                                 'status': pd.Categorical(statuses, categories=list(statuses_rgba.keys()))})
+        text = {'string': '{label}', 'size': LABEL_SIZE, 'anchor': 'upper_left', 'translation': [1, 2],
+                'color': {'feature': 'status', 'colormap': self._hex_colors()}}
+        self.layer = viewer.add_shapes(rectangles, shape_type='rectangle', name='Status Layer', features=features,
+                                       text=text, edge_width=self._edge_width(), face_color='transparent',
+                                       edge_color=self._edge_colors(statuses), scale=scale)
+        self.layer.mode = 'pan_zoom'
+        self.layer.editable = False
+
+    def _hex_colors(self):
+        return {status: '#{:02x}{:02x}{:02x}'.format(*rgba[:3]) for status, rgba in self.statuses_rgba.items()}
+
+    def _edge_colors(self, statuses):
+        if len(statuses) == 0: return np.zeros((0,4))
+        return np.array([self.statuses_rgba[status] for status in statuses], dtype=float) / 255
+
+    def _edge_width(self):
+        return EDGE_WIDTH if self.boxes_visible else 0
+
+    def _refresh(self):
+        self.layer.edge_color = self._edge_colors(self.layer.features['status'].tolist())
+        self.layer.refresh_text()
+
+    def set_status(self, cell_name, status):
+        ''' Recolor one cell's box and label. Returns False if the cell isn't on this page.'''
+        i = self.index.get(cell_name)
+        if i is None: return False
+        self.layer.features.loc[i, 'status'] = status
+        self._refresh()
+        return True
+
+    def set_statuses(self, statuses):
+        ''' statuses is a dict of cell name -> status. Cells not on this page are ignored.'''
+        features = self.layer.features
+        for name, status in statuses.items():
+            i = self.index.get(name)
+            if i is not None: features.loc[i, 'status'] = status
+        self._refresh()
+
+    def set_boxes_visible(self, visible):
+        ''' Show or hide the rectangles. Labels stay, like the raster layer. In label-only mode boxes are never shown.'''
+        self.boxes_visible = visible and not self.label_only
+        self.layer.edge_width = self._edge_width()
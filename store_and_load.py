@@ -9,9 +9,17 @@ Ting Lab
 2023
 '''
 
+import os
+import json
 import pickle
+import sqlite3
 import copy
+import threading
+import numpy as np
 import pandas as pd
+import object_data
+import decision_journal
+import decision_sidecar
 
 CELL_COLORS = ['gray', 'purple' , 'blue', 'green', 'orange','red', 'yellow', 'cyan', 'pink'] # List of colors available to use as colormaps
 DAPI = 0; OPAL570 = 1; OPAL690 = 2; OPAL480 = 3; OPAL620 = 4; OPAL780 = 5; OPAL520 = 6; AF=7 # Each fluor will be assigned a number that is used to represent it's position in the image array
@@ -36,6 +44,8 @@ VIEW_SETTINGS = {"DAPI gamma": 0.5, "OPAL570 gamma": 0.5, "OPAL690 gamma": 0.5,
                   "OPAL620 white-in": 255, "OPAL780 white-in": 255, "OPAL520 white-in": 255, 
                   "AF white-in": 255,"Sample AF white-in": 255,"Autofluorescence white-in": 255}
 
+_DISK_LOCK = threading.Lock() # Held while the object data .csv is being written, so two saves never overlap
+
 class sessionVariables:
     ''' Stores variables that will only last for the duration of a single session'''
     def __init__(self) -> None:
@@ -44,6 +54,25 @@ class sessionVariables:
         self.saved_notes = {}
         self.image_display_name = ""
         self.image_scale = None # None, or float representing pixels per micron
+        self.raster_pool = None # punchout_io.RasterPool holding open channel datasets, or None if the image is not read with rasterio
+        self.dirty_cells = set() # Names of cells whose status or note changed since the last save
+        self.row_lookup = None # (sorted keys, row positions, region codes) to find a cell's row in the object data. Built at the first save
+        self.journal = None # decision_journal.DecisionJournal that every change is appended to, once the viewer is running
+        self.unsaved_cells = set() # Names of cells folded into the table since decisions were last written to disk
+        self.sidecar_rows = [] # (region, id, status, note) rows taken by the disk write in progress, for the decision sidecar
+        self.write_snapshot = None # object_data.snapshot of the table taken by the disk write in progress
+
+    def record_status(self, cell_name, status):
+        ''' Set a cell's status and remember that it needs to be saved'''
+        self.status_list[cell_name] = status
+        self.dirty_cells.add(cell_name)
+        if self.journal is not None: self.journal.record_status(cell_name, status)
+
+    def record_note(self, cell_name, note):
+        ''' Set a cell's note and remember that it needs to be saved'''
+        self.saved_notes[cell_name] = note
+        self.dirty_cells.add(cell_name)
+        if self.journal is not None: self.journal.record_note(cell_name, note)
 
 class userPresets:
     ''' This class is used to store user-selected parameters on disk persistently,
@@ -58,6 +87,8 @@ class userPresets:
         self.qptiff = qptiff # String - image path
         self.objectDataPath = '' # String - object data path
         self.objectDataFrame = None # Pandas DataFrame created using read_csv. Storing this saves time when wanting the df later
+        self.objectDataSchema = None # object_data.ObjectDataSchema describing the columns of the object data. Built when the data is read
+        self.objectDataBitmaps = None # object_data.MembershipBitmaps of phenotype / annotation membership for each row of objectDataFrame
         self.imageSize = imageSize # Int - size of EACH punchout around a cell
         self.channels = channels # String array - user choice for channels to read and display
         self.UI_color_display = copy.copy(CELL_COLORS) # keep track of user selected colors for fluors
@@ -76,6 +107,10 @@ class userPresets:
         self.annotation_mappings = {} # Dict of user selected annotations and their status mappings. Cells in the data of these annotations will be kept for viewing and assigned the given status 
         self.annotation_mappings_label = '<u>Annotation Layer</u><br>All'# String representation of the above info for displaying in a QLabel
         self.analysisRegionsInData = False # Bool that tracks whether the object data has an 'Analysis Region' field with multiple annotations. Useful later
+        self.punchout_workers = None # Int - number of threads used to read cell images for a page. None means pick based on the CPU count
+        self.punchout_cache_mb = 1024 # Int - memory budget in MB for cell images kept in memory between pages and mode switches
+        self.decision_sidecar = False # Bool - save decisions to a small file next to the object data, and only write the .csv on export
+        self.vector_status_layer = False # Bool - draw cell status boxes and labels as napari shapes instead of an image layer
         self.session = sessionVariables()
 
 
@@ -129,59 +164,239 @@ class userPresets:
             self.objectDataFrame.insert(8,"Notes","-")
             self.objectDataFrame.fillna("")
         
-        status_copy = copy.copy(self.session.status_list)
-        for key, status in status_copy.items():
-            cid = key.split()[-1]
-            vals = [1 if x == status else 0 for x in list(self.statuses.keys())]
-            status_copy[key] = [key.replace(f' {cid}',''), int(cid),self.session.saved_notes[key], *vals]
-
-        # Create dataframe from stored dictionary and join with original df by assigning them the same kind of index
+        # Only the cells that changed since the last save are written, straight into their rows
         calls = [f"Validation | {status}" for status in list(self.statuses.keys())]
-        df = pd.DataFrame.from_dict(status_copy, orient = 'index', columns = ["Analysis Region", "Object Id",'Notes', *calls] )
-        if self.analysisRegionsInData:
-            self.objectDataFrame['new_index'] = self.objectDataFrame['Analysis Region'] +' '+ self.objectDataFrame['Object Id'].astype(str)
-        else:
-            df = df.drop(columns=['Analysis Region'])
-            self.objectDataFrame['new_index'] = 'All '+ self.objectDataFrame['Object Id'].astype(str)
-        self.objectDataFrame = self.objectDataFrame.set_index('new_index')
-        # Drop analysis region if it does not belong
-
-        self.objectDataFrame.update(df) # overwrite data with new cols
-        self.objectDataFrame[calls + ['Object Id']] = self.objectDataFrame[calls + ['Object Id']].astype(int)
-        # print(self.objectDataFrame.columns)
-        # print(self.objectDataFrame[calls].head(15))
+        names = list(self.session.dirty_cells)
+        if names:
+            positions = self._row_positions(names)
+            found = positions >= 0
+            if not found.all():
+                print(f'Could not find {[n for n, f in zip(names, found) if not f]} in the object data, their changes were not saved')
+            names = [n for n, f in zip(names, found) if f]; positions = positions[found]
+            self._fill_from_table(names, positions)
+            status_codes = np.array([list(self.statuses.keys()).index(self.session.status_list[n]) for n in names], dtype=np.intp)
+            calls_array = np.zeros((len(names), len(calls)), dtype=np.int8)
+            calls_array[np.arange(len(names)), status_codes] = 1
+            for j, col in enumerate(calls):
+                self.objectDataFrame.iloc[positions, self.objectDataFrame.columns.get_loc(col)] = calls_array[:, j]
+            if self.objectDataFrame["Notes"].dtype != object: # e.g. an all-blank column that was read as float
+                self.objectDataFrame["Notes"] = self.objectDataFrame["Notes"].astype(object)
+            self.objectDataFrame.iloc[positions, self.objectDataFrame.columns.get_loc("Notes")] = [self.session.saved_notes[n] for n in names]
+            self.session.unsaved_cells.update(names)
+        self.session.dirty_cells = set()
 
         if to_disk:
-            try:
-                self.objectDataFrame.to_csv(self.objectDataPath, index=False)
-                self.objectDataFrame.reset_index(drop=True,inplace=True)
-            except PermissionError:
-                self.objectDataFrame.reset_index(drop=True,inplace=True)
-                return False
-        
-            # hdata.loc[:,1:].to_excel(
-            # OBJECT_DATA,sheet_name='Exported from gallery viewer')
+            self.begin_disk_write()
+            return self.finish_disk_write()
+        return True
+
+    def _fill_from_table(self, names, positions):
+        ''' A cell replayed from the journal before the gallery is loaded can have a status but no note,
+            or a note but no status. Take whatever it is missing from its row in the table, so both
+            can be written back.'''
+        statuses = list(self.statuses.keys())
+        no_status = [i for i, n in enumerate(names) if n not in self.session.status_list]
+        if no_status:
+            is_call = self.objectDataFrame.iloc[positions[no_status]][[f"Validation | {s}" for s in statuses]].to_numpy() == 1
+            for i, found, code in zip(no_status, is_call.any(axis=1), is_call.argmax(axis=1)):
+                self.session.status_list[names[i]] = statuses[code] if found else 'Unseen'
+        notes = self.objectDataFrame["Notes"]
+        for i, n in enumerate(names):
+            if n not in self.session.saved_notes:
+                self.session.saved_notes[n] = notes.iloc[positions[i]] # as is, like the gallery does when it loads
+
+    def begin_disk_write(self, blocking = True):
+        ''' First half of a save, on the thread that makes decisions. Takes the disk lock, folds pending
+            decisions into the table and rotates the journal, so that nothing can land in between.
+            Returns False (without the lock) if blocking is False and a write is already running.'''
+        if not _DISK_LOCK.acquire(blocking=blocking):
+            return False
+        try:
+            self._save_validation(to_disk=False)
+            if self.session.journal is not None: self.session.journal.rotate()
+            self.session.sidecar_rows = self._sidecar_rows(self.session.unsaved_cells) if self._uses_sidecar() else []
+            calls = [f"Validation | {status}" for status in list(self.statuses.keys())]
+            self.session.write_snapshot = object_data.snapshot(self.objectDataFrame, calls + ['Notes'])
+            self.session.unsaved_cells = set()
+        except Exception:
+            _DISK_LOCK.release()
+            raise
+        return True
+
+    def finish_disk_write(self, progress = None, export = False):
+        ''' Second half of a save. Safe to run on a worker thread, it only reads the snapshot taken by
+            begin_disk_write. Writes the decisions (and the .csv, unless in sidecar mode and not exporting)
+            and releases the disk lock.'''
+        try:
+            return self._write_to_disk(progress, export)
+        finally:
+            self.session.write_snapshot = None
+            _DISK_LOCK.release()
+
+    def _write_to_disk(self, progress = None, export = False):
+        ''' Write the in-memory decisions to the decision sidecar and / or the object data .csv. The caller
+            must hold _DISK_LOCK and have rotated the journal. The rotated journal is only deleted once
+            the write has succeeded.'''
+        calls = [f"Validation | {status}" for status in list(self.statuses.keys())]
+        try:
+            if self.session.sidecar_rows:
+                decision_sidecar.DecisionSidecar(self.objectDataPath).write(self.session.sidecar_rows)
+            if export or not getattr(self, 'decision_sidecar', False):
+                # Only the viewer's columns are in memory. The rest of the file is streamed through unchanged
+                snapshot = self.session.write_snapshot
+                object_data.write_back(self.objectDataPath, snapshot, calls + ['Notes'], progress = progress)
+                object_data.write_cache(self.objectDataPath, snapshot) # keep the columnar copy in step with the .csv
+        except (PermissionError, sqlite3.OperationalError) as e:
+            print(e)
+            self._keep_unsaved()
+            return False
+        except ValueError as e: # The file no longer lines up with the data in memory
+            print(e)
+            self._keep_unsaved()
+            return False
+        self.session.sidecar_rows = []
+        if self.session.journal is not None: self.session.journal.discard_rotated()
         return True
 
+    def _keep_unsaved(self):
+        ''' A write failed, so the cells it was writing go back in the queue for the next one'''
+        self.session.unsaved_cells.update(f'{region} {cid}' for region, cid, _, _ in self.session.sidecar_rows)
+        self.session.sidecar_rows = []
+
+    def _uses_sidecar(self):
+        ''' Decisions go to the sidecar in sidecar mode, and also whenever a sidecar already exists so
+            that it never holds anything older than the .csv (it is applied over the .csv on load)'''
+        return getattr(self, 'decision_sidecar', False) or decision_sidecar.DecisionSidecar(self.objectDataPath).exists()
+
+    def _sidecar_rows(self, names):
+        rows = []
+        for name in names:
+            key = decision_sidecar.split_cell_name(name)
+            if key is None or name not in self.session.status_list: continue
+            rows.append((key[0], key[1], self.session.status_list[name], str(self.session.saved_notes.get(name, '-'))))
+        return rows
+
+    def load_decision_sidecar(self):
+        ''' Apply the decisions stored in the sidecar (if there is one) over the object data table.
+            Returns the number of cells updated.'''
+        sidecar = decision_sidecar.DecisionSidecar(self.objectDataPath)
+        if not sidecar.exists(): return 0
+        names = []
+        for region, cid, status, note in sidecar.read_all():
+            if status not in self.statuses: continue
+            name = f'{region} {cid}'
+            self.session.status_list[name] = status
+            self.session.saved_notes[name] = note
+            self.session.dirty_cells.add(name)
+            names.append(name)
+        self._save_validation(to_disk=False)
+        self.session.unsaved_cells.difference_update(names) # they came from the sidecar, no need to write them back
+        return len(names)
+
+    def open_journal(self):
+        ''' Start journaling decisions, after applying any that were left over from a session that
+            didn't get to save. Returns the number of records recovered.'''
+        journal = decision_journal.DecisionJournal(self.objectDataPath)
+        if not journal.acquire_session_lock():
+            print(f'{journal.lock_path} exists. Another viewer may have this data open, or the last session crashed.')
+        records = journal.replay()
+        for record in records: # replayed before the journal is attached, so they aren't written again
+            if record.get('status') in self.statuses:
+                self.session.record_status(record['cell'], record['status'])
+            elif 'note' in record:
+                self.session.record_note(record['cell'], record['note'])
+        if records: self._save_validation(to_disk=False) # fold them into the table
+        journal.open()
+        self.session.journal = journal
+        return len(records)
+
+    def journal_needs_compaction(self):
+        ''' True once enough decisions have been journaled that they should be folded into the .csv'''
+        journal = self.session.journal
+        return journal is not None and journal.records_since_rotate >= decision_journal.COMPACT_AFTER
+
+    def _row_positions(self, names):
+        ''' Return the row of each named cell ('<region> <id>', or 'All <id>') in the object data, -1 if missing.
+            The lookup is built once per session, rows don't move after the data is loaded.'''
+        df = self.objectDataFrame
+        if self.session.row_lookup is None or len(self.session.row_lookup[1]) != len(df.index):
+            ids = df['Object Id'].to_numpy(dtype=np.int64)
+            if self.analysisRegionsInData:
+                regions = pd.Categorical(df['Analysis Region'].astype(str))
+                region_codes = {name: code for code, name in enumerate(regions.categories)}
+                codes = regions.codes.astype(np.int64)
+            else:
+                region_codes = {'All': 0}
+                codes = np.zeros(len(ids), dtype=np.int64)
+            keys = codes * 2**32 + ids
+            order = np.argsort(keys, kind='stable') # stable, so a duplicated name finds its first row
+            self.session.row_lookup = (keys[order], order, region_codes)
+        sorted_keys, order, region_codes = self.session.row_lookup
+        positions = np.full(len(names), -1, dtype=np.int64)
+        for i, name in enumerate(names):
+            cell = decision_sidecar.split_cell_name(name) # only the trailing id, region names can hold numbers too
+            if cell is None or cell[0] not in region_codes: continue
+            key = np.int64(region_codes[cell[0]]) * 2**32 + np.int64(cell[1])
+            j = np.searchsorted(sorted_keys, key)
+            if j < len(sorted_keys) and sorted_keys[j] == key:
+                positions[i] = order[j]
+        return positions
+
+PRESETS_VERSION = 1 # Bump when the saved settings change shape, and add a step to _PRESET_MIGRATIONS
+_TRANSIENT_ATTRIBUTES = ('objectDataFrame', 'objectDataSchema', 'objectDataBitmaps', 'session') # Rebuilt every session, never saved
+_LEGACY_ATTRIBUTE_NAMES = {'objectData': 'objectDataPath'} # Old pickled attribute name -> current name
+
+def _migrate_pickled_settings(settings):
+    ''' Version 0 (a pickled userPresets) -> 1. Drops the table and anything else that isn't a setting.'''
+    settings = {_LEGACY_ATTRIBUTE_NAMES.get(k, k): v for k, v in settings.items() if k not in _TRANSIENT_ATTRIBUTES}
+    return settings
+
+_PRESET_MIGRATIONS = {0: _migrate_pickled_settings} # version -> function turning those settings into the next version's
+
+def _json_default(value):
+    if isinstance(value, np.generic): return value.item() # e.g. view settings read from a .viewsettings table
+    raise TypeError(f'{type(value).__name__} can\'t be saved in the presets')
+
+def preset_settings(obj : userPresets):
+    ''' The persistent part of a userPresets, as a dict of plain values'''
+    return {k: v for k, v in vars(obj).items() if k not in _TRANSIENT_ATTRIBUTES}
+
 def storeObject(obj : userPresets, filename : str):
-    ''' Write the class object to a file. Default location is data/presets'''
+    ''' Write the user's settings to a file as versioned JSON. Default location is data/presets.
+        The object data table is not saved here, it has its own cache next to the .csv (see object_data)'''
     try:
-        obj.session = sessionVariables() # reset per-session variables to save space
-        outfile = open(filename, 'wb' )
-        pickle.dump(obj, outfile)
-        outfile.close()
+        text = json.dumps({'version': PRESETS_VERSION, 'settings': preset_settings(obj)}, indent=1, default=_json_default)
+        with open(filename + '.saving', 'w', encoding='utf-8') as outfile:
+            outfile.write(text)
+        os.replace(filename + '.saving', filename) # a crash mid-write leaves the old presets intact
         return True
-    except:
+    except (OSError, TypeError, ValueError) as e:
+        print(f'Could not save presets: {e}')
         return False
-        
+
+def _read_settings(filename):
+    ''' Return (version, settings dict) from a presets file. Files from before the JSON format are pickles.'''
+    with open(filename, 'rb') as infile:
+        raw = infile.read()
+    try:
+        stored = json.loads(raw.decode('utf-8'))
+        return stored['version'], stored['settings']
+    except (UnicodeDecodeError, ValueError):
+        return 0, vars(pickle.loads(raw))
+
 def loadObject(filename):
-    ''' Read the class object from a file. Default location is data/presets'''
+    ''' Read the user's settings from a file. Default location is data/presets. Older formats are migrated,
+        and settings this version doesn't know about are ignored.'''
     try:
-        infile = open(filename,'rb')
-        new_obj = pickle.load(infile)
-        new_obj.session = sessionVariables() # just make sure nothing happened here
-        infile.close()
-        return new_obj
-    except:
+        version, settings = _read_settings(filename)
+        for step in range(version, PRESETS_VERSION):
+            settings = _PRESET_MIGRATIONS[step](settings)
+    except Exception:
         # If no data yet (first time running the viewer), load up defaults
-        return userPresets()
\ No newline at end of file
+        return userPresets()
+    new_obj = userPresets()
+    for key, value in settings.items():
+        if hasattr(new_obj, key) and key not in _TRANSIENT_ATTRIBUTES: setattr(new_obj, key, value)
+    new_obj.statuses_rgba = {k: tuple(v) for k, v in new_obj.statuses_rgba.items()} # JSON has no tuples
+    if version < PRESETS_VERSION: storeObject(new_obj, filename) # so the next start skips the migration
+    return new_obj
@@ -0,0 +1,17 @@
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+
+import cell_labels
+
+def test_display_text_moves_only_the_trailing_id():
+    assert cell_labels.display_text('Region 1 1') == '1 Region 1'
+    assert cell_labels.display_text('Region 12 1') == '1 Region 12'
+    assert cell_labels.display_text('All 42') == '42 All'
+
+def test_labels_are_cached_and_read_only():
+    label = cell_labels.render_label('Region 1 1', 16, 80, (0, 255, 0, 255), False)
+    assert label.shape == (16, 80, 4)
+    assert not label.flags.writeable
+    assert cell_labels.render_label('Region 1 1', 16, 80, (0, 255, 0, 255), False) is label
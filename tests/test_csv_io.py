@@ -0,0 +1,43 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+import csv_io
+import object_data
+
+TEXT = ('Analysis Region,Image Location,Object Id,XMin,XMax,YMin,YMax,CK Positive,DAPI Cell Intensity,Validation | Unseen,Notes\n'
+        'Region 1,C:\\scans\\slide 1.qptiff,0,10,20,10,20,1,12.3456789012345,1,-\n'
+        'Region 1,C:\\scans\\slide 1.qptiff,1,30,40,30,40,0,,1,"Needs, review"\n'
+        'Region 2,C:\\scans\\slide 1.qptiff,2,50,60,50,60,1,7,1,"said ""maybe"""\n')
+
+@pytest.fixture(params=csv_io.available_engines())
+def engine(request):
+    previous = csv_io.ENGINE
+    csv_io.set_engine(request.param)
+    yield request.param
+    csv_io.set_engine(previous)
+
+def test_untouched_file_round_trips_byte_for_byte(tmp_path, engine):
+    path = tmp_path / 'export.csv'
+    path.write_bytes(TEXT.encode())
+    df = pd.read_csv(path, dtype={'Notes': str})
+    object_data.write_back(str(path), df, ['Validation | Unseen', 'Notes'])
+    assert path.read_bytes() == TEXT.encode()
+
+def test_new_columns_go_in_at_position_8(tmp_path, engine):
+    path = tmp_path / 'export.csv'
+    path.write_bytes(TEXT.encode())
+    df = pd.read_csv(path, dtype={'Notes': str})
+    df['Validation | Confirmed'] = 0
+    object_data.write_back(str(path), df, ['Validation | Confirmed'])
+    assert csv_io.read_header(str(path))[8] == 'Validation | Confirmed'
+
+def test_text_chunks_match_across_engines(tmp_path):
+    path = tmp_path / 'export.csv'
+    path.write_bytes(TEXT.encode())
+    chunks = [pd.concat(list(csv_io.iter_chunks(str(path), as_text=True, engine=e)), ignore_index=True)
+              for e in csv_io.available_engines()]
+    for other in chunks[1:]:
+        pd.testing.assert_frame_equal(chunks[0], other)
+    assert chunks[0].loc[1, 'DAPI Cell Intensity'] == ''
+    assert chunks[0].loc[2, 'Notes'] == 'said "maybe"'
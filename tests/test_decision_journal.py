@@ -0,0 +1,59 @@
+import os
+
+import decision_journal
+
+def _journal(tmp_path):
+    return decision_journal.DecisionJournal(str(tmp_path / 'export.csv'))
+
+def test_records_replay_in_order(tmp_path):
+    journal = _journal(tmp_path)
+    journal.open()
+    journal.record_status('Region 1 0', 'Confirmed')
+    journal.record_note('Region 1 0', 'bright')
+    journal.record_status('Region 1 0', 'Rejected')
+    journal.close()
+    assert _journal(tmp_path).replay() == [{'cell': 'Region 1 0', 'status': 'Confirmed'},
+                                           {'cell': 'Region 1 0', 'note': 'bright'},
+                                           {'cell': 'Region 1 0', 'status': 'Rejected'}]
+
+def test_rotated_records_replay_until_discarded(tmp_path):
+    journal = _journal(tmp_path)
+    journal.open()
+    journal.record_status('Region 1 0', 'Confirmed')
+    journal.rotate()
+    assert journal.records_since_rotate == 0
+    journal.record_status('Region 1 1', 'Rejected')
+    journal.flush()
+    assert [r['cell'] for r in journal.replay()] == ['Region 1 0', 'Region 1 1']
+    journal.discard_rotated()
+    assert [r['cell'] for r in journal.replay()] == ['Region 1 1']
+    journal.close()
+
+def test_failed_save_keeps_earlier_rotation(tmp_path):
+    journal = _journal(tmp_path)
+    journal.open()
+    journal.record_status('Region 1 0', 'Confirmed')
+    journal.rotate() # this save fails, so the rotated file is kept
+    journal.record_status('Region 1 1', 'Rejected')
+    journal.rotate()
+    journal.close()
+    assert not os.path.exists(journal.path) or os.path.getsize(journal.path) == 0
+    assert [r['cell'] for r in journal.replay()] == ['Region 1 0', 'Region 1 1']
+
+def test_torn_last_line_is_skipped(tmp_path):
+    journal = _journal(tmp_path)
+    journal.open()
+    journal.record_status('Region 1 0', 'Confirmed')
+    journal.close()
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"cell": "Region 1 1", "sta')
+    assert _journal(tmp_path).replay() == [{'cell': 'Region 1 0', 'status': 'Confirmed'}]
+
+def test_session_lock_warns_once_taken(tmp_path):
+    first = _journal(tmp_path)
+    assert first.acquire_session_lock()
+    second = _journal(tmp_path)
+    assert not second.acquire_session_lock()
+    second.close()
+    assert not os.path.exists(first.lock_path)
+    assert _journal(tmp_path).acquire_session_lock()
@@ -0,0 +1,20 @@
+import decision_sidecar
+
+def test_split_cell_name():
+    assert decision_sidecar.split_cell_name('Region 1 42') == ('Region 1', 42)
+    assert decision_sidecar.split_cell_name('All 7') == ('All', 7)
+    assert decision_sidecar.split_cell_name('page') is None
+
+def test_missing_sidecar_reads_empty(tmp_path):
+    sidecar = decision_sidecar.DecisionSidecar(str(tmp_path / 'export.csv'))
+    assert not sidecar.exists()
+    assert sidecar.read_all() == []
+    assert sidecar.write([]) == 0
+    assert not sidecar.exists()
+
+def test_rows_are_upserted_by_region_and_id(tmp_path):
+    sidecar = decision_sidecar.DecisionSidecar(str(tmp_path / 'export.csv'))
+    assert sidecar.path == str(tmp_path / 'export.decisions.sqlite')
+    sidecar.write([('Region 1', 0, 'Confirmed', '-'), ('Region 2', 0, 'Rejected', 'dim')])
+    sidecar.write([('Region 1', 0, 'Needs review', 'recheck')])
+    assert sorted(sidecar.read_all()) == [('Region 1', 0, 'Needs review', 'recheck'), ('Region 2', 0, 'Rejected', 'dim')]
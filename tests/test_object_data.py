@@ -0,0 +1,54 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+np = pytest.importorskip('numpy')
+
+import object_data
+
+HEADER = 'Analysis Region,Object Id,XMin,XMax,YMin,YMax,CK Positive,DAPI Cell Intensity,Validation | Unseen,Notes\n'
+ROWS = ['Region 1,0,10,20,10,20,1,12.3456789012345,1,-\n',
+        'Region 1,1,30,40,30,40,0,0.000123456789,1,"Needs, review"\n']
+
+@pytest.fixture
+def export(tmp_path):
+    path = tmp_path / 'export.csv'
+    path.write_bytes((HEADER + ''.join(ROWS)).encode())
+    return path
+
+def test_write_back_keeps_intensity_text(export):
+    original = export.read_bytes()
+    data = object_data.ingest(str(export))
+    assert data.df['DAPI Cell Intensity'].dtype == np.float32
+    object_data.write_back(str(export), data.df, ['Validation | Unseen', 'Notes'])
+    assert export.read_bytes() == original
+
+def test_write_back_refuses_compacted_columns(export):
+    original = export.read_bytes()
+    data = object_data.ingest(str(export))
+    with pytest.raises(ValueError):
+        object_data.write_back(str(export), data.df, ['DAPI Cell Intensity'])
+    assert export.read_bytes() == original
+
+def test_snapshot_does_not_see_later_decisions(export):
+    df = object_data.ingest(str(export)).df.copy()
+    snap = object_data.snapshot(df, ['Validation | Unseen', 'Notes'])
+    df.iloc[0, df.columns.get_loc('Validation | Unseen')] = 0
+    df.iloc[0, df.columns.get_loc('Notes')] = 'changed'
+    assert snap['Validation | Unseen'].tolist() == [1, 1]
+    assert snap.loc[0, 'Notes'] == '-'
+
+def test_ingest_loads_only_the_viewer_columns(tmp_path):
+    path = tmp_path / 'export.csv'
+    path.write_text('Object Id,Cell Area (µm²),CK Positive,Validation | Unseen\n0,12.5,1,1\n1,8,0,1\n', encoding='utf-8')
+    data = object_data.ingest(str(path))
+    assert list(data.df.columns) == ['Object Id', 'CK Positive', 'Validation | Unseen']
+    assert data.schema.headers[1] == 'Cell Area (µm²)'
+
+@pytest.mark.parametrize('rows', [1, 3])
+def test_write_back_refuses_a_file_that_changed(export, rows):
+    original = export.read_bytes()
+    df = pd.DataFrame({'Validation | Unseen': [1] * rows, 'Notes': ['-'] * rows})
+    with pytest.raises(ValueError):
+        object_data.write_back(str(export), df, ['Validation | Unseen', 'Notes'])
+    assert export.read_bytes() == original
+    assert not (export.parent / 'export.csv.saving').exists()
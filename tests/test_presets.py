@@ -0,0 +1,59 @@
+import json
+import pickle
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+import store_and_load
+
+def test_settings_round_trip_as_json(tmp_path):
+    filename = str(tmp_path / 'presets')
+    presets = store_and_load.userPresets()
+    presets.objectDataPath = 'C:/data/export.csv'
+    presets.page_size = 24
+    presets.view_settings = dict(presets.view_settings, **{'DAPI gamma': np.float64(0.7)}) # as read from a .viewsettings table
+    presets.objectDataFrame = pd.DataFrame({'Object Id': [0, 1]})
+    assert store_and_load.storeObject(presets, filename)
+
+    with open(filename, encoding='utf-8') as f:
+        stored = json.load(f)
+    assert stored['version'] == store_and_load.PRESETS_VERSION
+    assert not set(store_and_load._TRANSIENT_ATTRIBUTES) & set(stored['settings'])
+
+    loaded = store_and_load.loadObject(filename)
+    assert loaded.objectDataPath == 'C:/data/export.csv'
+    assert loaded.page_size == 24
+    assert loaded.view_settings['DAPI gamma'] == 0.7
+    assert loaded.objectDataFrame is None
+    assert loaded.statuses_rgba == store_and_load.STATUSES_RGBA
+
+def test_unknown_settings_are_ignored(tmp_path):
+    filename = tmp_path / 'presets'
+    filename.write_text(json.dumps({'version': store_and_load.PRESETS_VERSION,
+                                    'settings': {'page_size': 12, 'from_a_newer_version': True}}))
+    loaded = store_and_load.loadObject(str(filename))
+    assert loaded.page_size == 12
+    assert not hasattr(loaded, 'from_a_newer_version')
+
+def test_pickled_presets_are_migrated(tmp_path):
+    filename = str(tmp_path / 'presets')
+    legacy = store_and_load.userPresets()
+    legacy.objectData = 'C:/data/export.csv' # the attribute's old name
+    del legacy.objectDataPath
+    legacy.imageSize = 150
+    legacy.objectDataFrame = pd.DataFrame({'Object Id': [0, 1]})
+    with open(filename, 'wb') as f:
+        pickle.dump(legacy, f)
+
+    loaded = store_and_load.loadObject(filename)
+    assert loaded.objectDataPath == 'C:/data/export.csv'
+    assert loaded.imageSize == 150
+    assert loaded.objectDataFrame is None
+    with open(filename, encoding='utf-8') as f: # rewritten as JSON
+        assert json.load(f)['version'] == store_and_load.PRESETS_VERSION
+
+def test_missing_file_gives_defaults(tmp_path):
+    loaded = store_and_load.loadObject(str(tmp_path / 'presets'))
+    assert loaded.page_size == store_and_load.userPresets().page_size
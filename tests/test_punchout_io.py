@@ -0,0 +1,37 @@
+import threading
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('rasterio')
+
+import punchout_io
+
+def _pyramid():
+    return np.arange(64*64*2, dtype=np.uint32).reshape(64, 64, 2).astype(np.uint8)
+
+def test_page_punchouts_match_single_reads():
+    pyramid = _pyramid()
+    centers = [(10, 10), (30, 40)]
+    page = punchout_io.extract_page_punchouts(centers, [0, 1], 4, pyramid=pyramid, workers=4)
+    for i, (x, y) in enumerate(centers):
+        for j in range(2):
+            assert (page[i, j] == punchout_io.read_punchout(x, y, 4, j, pyramid=pyramid)).all()
+
+def test_cancelled_reads_are_skipped():
+    page = punchout_io.extract_page_punchouts([(10, 10), (30, 40)], [0, 1], 4, pyramid=_pyramid(),
+                                              workers=4, cancelled=lambda: True)
+    assert not page.any()
+
+def test_cancel_stops_a_fill_that_is_running():
+    started = threading.Event(); release = threading.Event(); seen = []
+    def read_cells(cells, cancelled):
+        started.set(); release.wait(5)
+        seen.append(cancelled())
+    prefetcher = punchout_io.PagePrefetcher(read_cells)
+    prefetcher.retarget([[['Region 1', 0, 10, 10]]])
+    assert started.wait(5)
+    prefetcher.cancel()
+    release.set()
+    prefetcher.shutdown()
+    assert seen == [True]
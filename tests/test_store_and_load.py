@@ -0,0 +1,49 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+import decision_journal
+import store_and_load
+
+HEADER = ('Analysis Region,Object Id,XMin,XMax,YMin,YMax,CK Positive,DAPI Cell Intensity,Validation | Unseen,'
+          'Validation | Needs review,Validation | Confirmed,Validation | Rejected,Validation | Interesting,Notes\n')
+ROWS = ['Region 1,0,10,20,10,20,1,12.5,1,0,0,0,0,-\n',
+        'Region 1,1,30,40,30,40,0,3.25,0,0,0,1,0,dim\n',
+        'Region 2,0,50,60,50,60,1,7,1,0,0,0,0,-\n']
+
+def _presets(path):
+    presets = store_and_load.userPresets()
+    presets.objectDataPath = str(path)
+    presets.objectDataFrame = pd.read_csv(path, dtype={'Analysis Region': str, 'Notes': str})
+    presets.analysisRegionsInData = True
+    return presets
+
+def test_replayed_journal_saves_into_a_fresh_session(tmp_path, capsys):
+    path = tmp_path / 'export.csv'
+    path.write_text(HEADER + ''.join(ROWS))
+    crashed = decision_journal.DecisionJournal(str(path))
+    crashed.open()
+    crashed.record_status('Region 1 0', 'Confirmed') # status only
+    crashed.record_note('Region 1 1', 'recheck') # note only
+    crashed.close()
+
+    presets = _presets(path)
+    assert presets.open_journal() == 2
+    assert presets._save_validation(to_disk=True)
+    presets.session.journal.close()
+    assert 'Could not find' not in capsys.readouterr().out # every replayed cell found its row
+
+    saved = pd.read_csv(path, dtype={'Analysis Region': str, 'Notes': str})
+    assert saved.loc[0, 'Validation | Confirmed'] == 1 and saved.loc[0, 'Validation | Unseen'] == 0
+    assert saved.loc[0, 'Notes'] == '-' # its note came from the table
+    assert saved.loc[1, 'Notes'] == 'recheck'
+    assert saved.loc[1, 'Validation | Rejected'] == 1 # its status came from the table
+    assert saved.loc[2, 'Validation | Unseen'] == 1
+    assert decision_journal.DecisionJournal(str(path)).replay() == []
+
+def test_row_positions_with_numbers_in_region_names(tmp_path):
+    path = tmp_path / 'export.csv'
+    path.write_text(HEADER + 'Region 12 1,1,0,1,0,1,0,1,1,0,0,0,0,-\n' + ''.join(ROWS))
+    presets = _presets(path)
+    positions = presets._row_positions(['Region 1 1', 'Region 12 1 1', 'Region 2 0', 'Region 1 5', 'page'])
+    assert positions.tolist() == [2, 0, 3, -1, -1]